@@ -0,0 +1,399 @@
+"""
+Benchmarks for the hot paths of nb_unittest.
+
+The benchmarks run headless in an in-process InteractiveShell with synthetic
+cells and notebooks of increasing size. Each benchmark reports the best time
+per call over several repeats.
+
+    python bench.py                      Run every benchmark.
+    python bench.py -k analysis          Run the benchmarks that match.
+    python bench.py --save baseline.json Save the times as a baseline.
+    python bench.py --compare baseline.json
+                                         Fail if a benchmark got slower than
+                                         the baseline by more than --tolerance.
+                                         Without the baseline, only run them.
+
+Baselines are only comparable on the machine that made them, so they aren't
+kept in the repository. A benchmark that looks slower than its baseline is
+measured again with more repeats before it's reported, so one noisy run isn't
+a regression.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import timeit
+from functools import partial
+from pathlib import Path
+from typing import Callable
+
+from IPython.core.interactiveshell import InteractiveShell
+
+import nb_unittest
+from nb_unittest.analysis import AnalysisNode
+from nb_unittest.static import load_notebook
+from nb_unittest.tagcache import TagCacheEntry
+
+# The number of functions in the synthetic cells.
+SIZES = (1, 10, 100)
+
+# Benchmark names and functions that set up a benchmark and return the
+# callable to time.
+BENCHMARKS = {}
+
+# The AnalysisNode properties that are timed on a whole cell.
+PROPERTIES = (
+    "tree",
+    "docstring",
+    "facts",
+    "tokens",
+    "functions",
+    "classes",
+    "assignments",
+    "references",
+    "constants",
+    "calls",
+    "imports",
+)
+
+_shell = None
+
+
+def benchmark(name: str, sizes: tuple[int, ...] = SIZES) -> Callable:
+    """Register a benchmark for each size."""
+
+    def decorator(setup: Callable) -> Callable:
+        for size in sizes:
+            BENCHMARKS[f"{name}[{size}]"] = partial(setup, size)
+        return setup
+
+    return decorator
+
+
+def make_cell(size: int, tag: str = "@bench") -> str:
+    """Make a tagged cell with `size` functions and a class."""
+    parts = [f'"""\nA synthetic cell.\n{tag}\n"""\n\nimport math\n']
+    for i in range(size):
+        parts.append(
+            f"""
+def function_{i}(items, limit={i}):
+    \"\"\"Function {i}.\"\"\"
+    total = 0
+    for j in range(len(items)):
+        if items[j] > limit:
+            total += math.sqrt(items[j])
+        else:
+            total -= abs(items[j])
+    while total > 100:
+        total = total / 2
+    return [x * 2 for x in items if x], total
+"""
+        )
+    parts.append(
+        f"""
+class Synthetic:
+    def method(self):
+        return function_0([1, 2, 3])
+
+value = {size} + 1
+value
+"""
+    )
+    return "".join(parts)
+
+
+def make_tests(size: int, asynchronous: bool = False) -> str:
+    """Make a %%testing cell with `size` passing tests."""
+    prefix = "async " if asynchronous else ""
+    lines = ["%%testing @bench"]
+    for i in range(size):
+        lines.append(f"{prefix}def test_{i}():\n    assert bench\n")
+    return "\n".join(lines)
+
+
+def make_notebook(path: Path, size: int) -> Path:
+    """Write a notebook with `size` tagged cells."""
+    cells = [
+        {
+            "cell_type": "code",
+            "execution_count": None,
+            "id": f"cell-{i}",
+            "metadata": {},
+            "outputs": [],
+            "source": make_cell(3, f"@cell{i}"),
+        }
+        for i in range(size)
+    ]
+    nb = {"cells": cells, "metadata": {}, "nbformat": 4, "nbformat_minor": 5}
+    path.write_text(json.dumps(nb))
+    return path
+
+
+def get_shell() -> InteractiveShell:
+    global _shell
+    if _shell is None:
+        _shell = InteractiveShell.instance()
+        # Results are stored in the history for the tag cache, but they don't
+        # need to be kept.
+        _shell.displayhook.cache_size = 0
+        _shell.run_cell("%load_ext nb_unittest")
+    return _shell
+
+
+def run_cell(source: str, store_history: bool = True):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return get_shell().run_cell(source, store_history=store_history)
+
+
+def run_in_cell(statement: str, calls: int) -> Callable:
+    """
+    Return a function that runs `statement` `calls` times in one cell. Outside
+    of a cell IPython's display trap takes over run()'s capture, so run() is
+    only timed the way a notebook calls it. The time is reported per call, the
+    calls share the cost of running the cell.
+    """
+    source = f"for _ in range({calls}):\n    {statement}"
+
+    def run():
+        run_cell(source, store_history=False)
+
+    run.calls = calls
+    return run
+
+
+@benchmark("parse")
+def bench_parse(size):
+    source = make_cell(size)
+    return lambda: AnalysisNode(source)
+
+
+for _name in PROPERTIES:
+
+    @benchmark(f"analysis.{_name}")
+    def bench_property(size, name=_name):
+        # Each call gets a new node on the same tree, so only the property
+        # is timed and nothing it caches is reused.
+        node = AnalysisNode(make_cell(size))
+        source, tree = node._source, node._tree
+        return lambda: getattr(AnalysisNode(source, tree), name)
+
+
+@benchmark("analysis.source")
+def bench_source(size):
+    # The source of a cell is returned as it is, so slice out the class at
+    # the end of the cell instead. Each call gets a new node, the lines are
+    # split once per node.
+    node = AnalysisNode(make_cell(size)).classes["Synthetic"]
+    source, tree = node._source, node._tree
+    return lambda: AnalysisNode(source, tree).source
+
+
+@benchmark("analysis.arguments")
+def bench_arguments(size):
+    function = AnalysisNode(make_cell(size)).functions["function_0"]
+    return lambda: function.arguments
+
+
+@benchmark("analysis.match")
+def bench_match(size):
+    node = AnalysisNode(make_cell(size))
+    source, tree = node._source, node._tree
+    rules = (
+        "For(iter=Call(func=Name('range')))",
+        "While(test=Compare) & ~Has(Break())",
+        "Call(func=Name('abs'))",
+    )
+
+    def match():
+        node = AnalysisNode(source, tree)
+        for rule in rules:
+            node.match(rule)
+
+    return match
+
+
+@benchmark("entry.create")
+def bench_entry_create(size):
+    result = run_cell(make_cell(size))
+    shell = get_shell()
+    return lambda: TagCacheEntry(result, shell)
+
+
+@benchmark("entry.facts")
+def bench_entry_facts(size):
+    # The parse isn't shared because each entry is dropped after the call.
+    result = run_cell(make_cell(size))
+    shell = get_shell()
+    return lambda: TagCacheEntry(result, shell).facts
+
+
+@benchmark("tagging.post_run_cell")
+def bench_post_run_cell(size):
+    result = run_cell(make_cell(size))
+    return lambda: nb_unittest._cache.post_run_cell(result)
+
+
+@benchmark("static.load_notebook")
+def bench_load_notebook(size):
+    path = make_notebook(Path(tempfile.mkdtemp()) / "bench.ipynb", size)
+    return lambda: [cell.facts for cell in load_notebook(path).cells]
+
+
+@benchmark("testing.sync")
+def bench_testing_sync(size):
+    run_cell(make_cell(1))
+    source = make_tests(size)
+    return lambda: run_cell(source)
+
+
+@benchmark("testing.async")
+def bench_testing_async(size):
+    run_cell(make_cell(1))
+    source = make_tests(size, asynchronous=True)
+
+    async def run():
+        run_cell(source)
+        await nb_unittest._cache.scheduler.wait()
+
+    return lambda: asyncio.run(run())
+
+
+@benchmark("run.call", sizes=(1,))
+def bench_run(size):
+    run_cell('"""@small"""\nx = 1\nx')
+    return run_in_cell('nb_unittest.get("@small").run()', 1000)
+
+
+@benchmark("run.push", sizes=(1,))
+def bench_run_push(size):
+    run_cell('"""@small"""\nx = 1\nx')
+    return run_in_cell('nb_unittest.get("@small").run({"x": 2})', 1000)
+
+
+@benchmark("run.many", sizes=(100,))
+def bench_run_many(size):
+    run_cell('"""@small"""\nx = 1\nx')
+    get_shell().user_ns["pushes"] = [{"x": i} for i in range(size)]
+    return run_in_cell('nb_unittest.get("@small").run_many(pushes)', 100)
+
+
+@benchmark("import", sizes=(1,))
+def bench_import(size):
+    # Each call imports nb_unittest in a new interpreter after the parts of
+    # IPython it needs, and returns the time that -X importtime reports for
+    # nb_unittest alone. Starting the interpreter would hide a regression.
+    code = "import IPython.core.magic, IPython.display; import nb_unittest"
+
+    def run():
+        out = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        last = out.stderr.strip().splitlines()[-1]
+        assert last.endswith("| nb_unittest"), last
+        return int(last.split("|")[1]) / 1e6
+
+    run.reports = True
+    return run
+
+
+def measure(setup: Callable, repeat: int) -> Callable[[int], float]:
+    """
+    Return a function that times `repeat` more repeats and returns the best
+    time per call in seconds over all of the repeats so far. A function with
+    a `reports` attribute times itself and returns the time of one call.
+    """
+    function = setup()
+    times = []
+    if getattr(function, "reports", False):
+
+        def more(repeat: int = repeat) -> float:
+            times.extend(function() for _ in range(repeat))
+            return min(times)
+
+        return more
+
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    calls = number * getattr(function, "calls", 1)
+
+    def more(repeat: int = repeat) -> float:
+        times.extend(timer.repeat(repeat, number))
+        return min(times) / calls
+
+    return more
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "-k", dest="pattern", default="", help="Only run matching names."
+    )
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--save", metavar="FILE", help="Save a baseline.")
+    parser.add_argument(
+        "--compare", metavar="FILE", help="Compare with a baseline."
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=2.0,
+        help="How many times slower than the baseline is a regression.",
+    )
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if args.compare and not Path(args.compare).exists():
+        # A fresh checkout has no baseline, so there's nothing to compare.
+        print(f"No baseline in {args.compare}, save one with --save.")
+    elif args.compare:
+        baseline = json.loads(Path(args.compare).read_text())["times"]
+
+    times = {}
+    regressions = []
+    for name, setup in BENCHMARKS.items():
+        if args.pattern not in name:
+            continue
+        timer = measure(setup, args.repeat)
+        times[name] = timer()
+        if name in baseline and times[name] > baseline[name] * args.tolerance:
+            # Make sure with more repeats, the best time is the least noisy.
+            times[name] = timer(args.repeat * 4)
+        line = f"{name:40} {times[name] * 1e6:12.1f} µs"
+        if name in baseline:
+            ratio = times[name] / baseline[name]
+            line += f" {ratio:6.2f}x"
+            if ratio > args.tolerance:
+                regressions.append(name)
+                line += " REGRESSION"
+        print(line, flush=True)
+
+    if args.save:
+        Path(args.save).write_text(
+            json.dumps(
+                {
+                    "python": platform.python_version(),
+                    "machine": platform.machine(),
+                    "times": times,
+                },
+                indent=2,
+            )
+            + "\n"
+        )
+
+    if regressions:
+        print(f"{len(regressions)} regressions: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,16 +9,22 @@ from functools import wraps
 from typing import Callable, Iterator
 
 from . import tagcache
+from .complexity import assert_complexity
+from .static import load_notebook
 from .tagcache import assert_error, assert_ok, nbtest_attrs
 
 _cache = None
 
 __all__ = [
     "nbtest_attrs",
+    "assert_complexity",
     "assert_error",
     "assert_ok",
     "get",
+    "history",
     "items",
+    "load_notebook",
+    "persist",
     "tags",
     "warning",
     "info",
@@ -36,6 +42,26 @@ def get(tag: str) -> tagcache.TagCacheEntry:
     return _cache._cache[tag]
 
 
+def history(tag: str) -> list[tagcache.TagCacheEntry]:
+    """
+    Retrieve the recent versions of a tagged cell, oldest first. Only the
+    newest version keeps the value of its result.
+    """
+    if _cache is None:
+        raise RuntimeError("The nbtest extension has not been loaded.")
+    return _cache._cache.history(tag)
+
+
+def persist(path: str) -> None:
+    """
+    Keep tagged cells in a database at `path` so that they're available
+    after the kernel restarts. Cells saved there before are loaded.
+    """
+    if _cache is None:
+        raise RuntimeError("The nbtest extension has not been loaded.")
+    _cache.persist(path)
+
+
 def items() -> Iterator[tuple[str, tagcache.TagCacheEntry]]:
     """Return an iterator of cell cell tags and cache entries."""
     return _cache._cache.items()
@@ -78,4 +104,17 @@ def load_ipython_extension(ipython):
     global _cache
     _cache = tagcache.TagCache(ipython)
     ipython.register_magics(_cache)
+    ipython.events.register("pre_run_cell", _cache.pre_run_cell)
     ipython.events.register("post_run_cell", _cache.post_run_cell)
+    if tagcache.persist_path is not None:
+        _cache.persist(tagcache.persist_path)
+
+
+def unload_ipython_extension(ipython):
+    global _cache
+    ipython.events.unregister("pre_run_cell", _cache.pre_run_cell)
+    ipython.events.unregister("post_run_cell", _cache.post_run_cell)
+    _cache.scheduler.cancel()
+    if _cache.database is not None:
+        _cache.database.close()
+    _cache = None
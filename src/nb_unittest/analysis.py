@@ -4,8 +4,13 @@ Helpers that analyze code cells.
 
 import ast
 import copy
+import re
 import types
 import typing
+from collections import Counter
+from dataclasses import dataclass, field
+
+from .patterns import compile_pattern
 
 
 class AnalysisNode:
@@ -24,6 +29,11 @@ class AnalysisNode:
 
         self._source = source
         self._tree = tree
+        self._facts = None
+        self._functions = None
+        self._classes = None
+        self._lines = None
+        self._index = None
         if tree is None and source is not None:
             self._tree = ast.parse(source)
 
@@ -33,66 +43,63 @@ class AnalysisNode:
         The source corresponding to the tokens in tree. If this node is a
         subtree only the source corresponding to the subtree is returned.
         """
-        src = ast.get_source_segment(self._source, self._tree)
-        if src is None:
+        node = self._tree
+        if getattr(node, "end_lineno", None) is None:
             return self._source
-        else:
-            return src
+
+        if self._lines is None:
+            # Split lines the way the parser counts them, once per node.
+            self._lines = re.split(r"(?<=\n)|(?<=\r)(?!\n)", self._source)
+
+        first = node.lineno - 1
+        last = node.end_lineno - 1
+        if first == last:
+            line = self._lines[first].encode()
+            return line[node.col_offset : node.end_col_offset].decode()
+
+        return "".join(
+            [
+                self._lines[first].encode()[node.col_offset :].decode(),
+                *self._lines[first + 1 : last],
+                self._lines[last].encode()[: node.end_col_offset].decode(),
+            ]
+        )
 
     @property
-    def tree(self) -> ast.Module:
+    def tree(self) -> "TreeView":
         """
-        A deep copy of the parse tree or subtree that corresponding to this
-        node.
+        A read-only view of the parse tree or subtree that corresponds to this
+        node. Use `tree.copy()` to get a copy of the tree that can be changed.
         """
-        if self._tree.__class__ == MarkerNode:
-            # Don't show users my fake node.
-            return copy.deepcopy(self._tree._real_node)
-        else:
-            return copy.deepcopy(self._tree)
+        return TreeView(self._node)
 
     @property
     def docstring(self) -> typing.Union[str, None]:
         """The docstring of this node. `None` if there is no docstring."""
+        return ast.get_docstring(self._node)
+
+    @property
+    def _node(self) -> ast.AST:
         if self._tree.__class__ == MarkerNode:
-            return ast.get_docstring(self._tree._real_node)
-        return ast.get_docstring(self._tree)
+            # Don't show users my fake node.
+            return self._tree._real_node
+        return self._tree
+
+    @property
+    def facts(self) -> "Facts":
+        """
+        Facts about this node that are gathered in a single pass over the
+        tree. The facts are computed on first use and shared by the other
+        properties.
+        """
+        if self._facts is None:
+            self._facts = FactFinder().find(self._tree)
+        return self._facts
 
     @property
     def tokens(self) -> set:
         """A set of token classes from the current scope."""
-
-        class RootExtractor(ast.NodeTransformer):
-            def __init__(self):
-                self.depth = 0
-
-            def delete_body(self, node: ast.AST):
-                if self.depth == 0:
-                    self.depth += 1
-                    self.generic_visit(node)
-                    self.depth -= 1
-                else:
-                    node.body = []
-                return node
-
-            def visit_Module(self, node):
-                self.depth += 1
-                self.generic_visit(node)
-                self.depth = -1
-                return node
-
-            def visit_ClassDef(self, node: ast.ClassDef):
-                return self.delete_body(node)
-
-            def visit_FunctionDef(self, node: ast.FunctionDef):
-                return self.delete_body(node)
-
-            def visit_AsyncFunctionDef(self, node: ast.AsyncFunctionDef):
-                return self.delete_body(node)
-
-        return set(
-            (x.__class__ for x in ast.walk(RootExtractor().visit(self.tree)))
-        )
+        return set(self.facts.tokens)
 
     @property
     def functions(self) -> dict[str, types.FunctionType]:
@@ -100,23 +107,12 @@ class AnalysisNode:
         A dictionary of the names of defined functions and their corresponding
         AnalysisNode.
         """
-        found = {}
-
-        class FindFunctions(RootNodeFinder):
-            """
-            A visitor that finds function definitions at the top level of the
-            tree.
-            """
-
-            def visit_FunctionDef(_, node: ast.FunctionDef):
-                found[node.name] = AnalysisNode(self._source, MarkerNode(node))
-
-            def visit_AsyncFunctionDef(_, node: ast.FunctionDef):
-                found[node.name] = AnalysisNode(self._source, MarkerNode(node))
-
-        finder = FindFunctions()
-        finder.visit(self._tree)
-        return found
+        if self._functions is None:
+            self._functions = {
+                name: self._child(node)
+                for name, node in self.facts.functions.items()
+            }
+        return dict(self._functions)
 
     @property
     def classes(self) -> dict[str, type]:
@@ -124,58 +120,25 @@ class AnalysisNode:
         A dictionary of the names of defined classes and their corresponding
         AnalysisNode.
         """
-        found = {}
-
-        class FindClasses(RootNodeFinder):
-            """
-            A visitor that finds class definitions at the top level of the tree.
-            """
-
-            def visit_ClassDef(_, node: ast.ClassDef):
-                found[node.name] = AnalysisNode(self._source, MarkerNode(node))
-
-        finder = FindClasses()
-        finder.visit(self._tree)
-        return found
-
-    def _assignments(self) -> list[str]:
-        found = []
-
-        class FindAssignments(RootNodeFinder):
-            def visit_Name(self, node: ast.Name):
-                if isinstance(node.ctx, ast.Store):
-                    found.append(node.id)
-                self.generic_visit(node)
-
-        finder = FindAssignments()
-        finder.visit(self._tree)
-        return found
+        if self._classes is None:
+            self._classes = {
+                name: self._child(node)
+                for name, node in self.facts.classes.items()
+            }
+        return dict(self._classes)
 
     @property
     def assignments(self) -> set[str]:
         """
         The set of the names of assigned variables in this node.
         """
-        return set(self._assignments())
+        return set(self.facts.assignments)
 
-    def count_assignments(self, name) -> set[str]:
+    def count_assignments(self, name) -> int:
         """
         Count the number of times the variable `name` is assigned.
         """
-        return self._assignments().count(name)
-
-    def _references(self) -> list[str]:
-        found = []
-
-        class FindAllNames(RootNodeFinder):
-            def visit_Name(self, node: ast.Name):
-                if isinstance(node.ctx, ast.Load):
-                    found.append(node.id)
-                self.generic_visit(node)
-
-        finder = FindAllNames()
-        finder.visit(self._tree)
-        return found
+        return self.facts.assignments[name]
 
     @property
     def references(self) -> set[str]:
@@ -183,61 +146,33 @@ class AnalysisNode:
         The set of the names of referenced attributes in this node. References
         are context loads, not stores. Assignments do not count as references.
         """
-        return set(self._references())
+        return set(self.facts.references)
 
-    def count_references(self, name) -> set[str]:
+    def count_references(self, name) -> int:
         """
         Count the number of times the symbol `name` is referenced.
         """
-        return self._references().count(name)
+        return self.facts.references[name]
 
     @property
     def constants(self) -> set[typing.Any]:
         """
         The set of all literal values in this node.
         """
-        found = []
-
-        class FindConstants(RootNodeFinder):
-            def visit_Constant(self, node: ast.Constant):
-                found.append(node.value)
-                self.generic_visit(node)
-
-        finder = FindConstants()
-        finder.visit(self._tree)
-        return set(found)
-
-    def _calls(self) -> list[str]:
-        """
-        The set of names of the functions called in this node.
-        """
-        found = []
-
-        class FindCalls(RootNodeFinder):
-            def visit_Call(self, node: ast.Call):
-                found.append(
-                    node.func.id
-                    if hasattr(node.func, "id")
-                    else node.func.attr
-                )
-                self.generic_visit(node)
-
-        finder = FindCalls()
-        finder.visit(self._tree)
-        return found
+        return set(self.facts.constants)
 
     @property
     def calls(self) -> set[str]:
         """
         The set of names of the functions called in this node.
         """
-        return set(self._calls())
+        return set(self.facts.calls)
 
-    def count_calls(self, name) -> set[str]:
+    def count_calls(self, name) -> int:
         """
         Count the number of times the function `name` is called.
         """
-        return self._calls().count(name)
+        return self.facts.calls[name]
 
     @property
     def arguments(self) -> set[str]:
@@ -247,7 +182,7 @@ class AnalysisNode:
         """
         found = []
 
-        t = self.tree
+        t = self._node
         if t.__class__ not in (ast.FunctionDef, ast.AsyncFunctionDef):
             raise ValueError("Cannot call arguments on a non-function.")
 
@@ -277,19 +212,83 @@ class AnalysisNode:
         import foo as bar
         from foo import bak
         """
+        return set(self.facts.imports)
+
+    def match(self, pattern: str) -> list["AnalysisNode"]:
+        """
+        Find the nodes in this node's tree, including nested definitions,
+        that match a structural pattern. For example, loops over `range()`:
+
+            node.match("For(iter=Call(func=Name('range')))")
+
+        See nb_unittest.patterns for the pattern syntax. Matches are returned
+        in source order.
+        """
+        compiled = compile_pattern(pattern)
         found = []
+        for cls, nodes in self._node_index().items():
+            if issubclass(cls, compiled.types):
+                found += [node for node in nodes if compiled.test(node)]
+        found.sort(
+            key=lambda n: (
+                getattr(n, "lineno", 0),
+                getattr(n, "col_offset", 0),
+            )
+        )
+        return [
+            self._child(node)
+            if isinstance(node, _definitions)
+            else self._subtree(node)
+            for node in found
+        ]
+
+    def matches(self, pattern: str) -> bool:
+        """True if something in this node's tree matches the pattern."""
+        compiled = compile_pattern(pattern)
+        return any(
+            compiled.test(node)
+            for cls, nodes in self._node_index().items()
+            if issubclass(cls, compiled.types)
+            for node in nodes
+        )
 
-        class FindImports(RootNodeFinder):
-            def visit_Import(self, node: ast.Call):
-                nonlocal found
-                found += [alias.name for alias in node.names]
+    def _node_index(self) -> dict[type, list[ast.AST]]:
+        # Nodes by class, made in one walk and shared by every pattern.
+        if self._index is None:
+            self._index = {}
+            for node in ast.walk(self._node):
+                self._index.setdefault(node.__class__, []).append(node)
+        return self._index
 
-            def visit_ImportFrom(self, node: ast.Call):
-                found.append(node.module)
+    def _subtree(self, node: ast.AST) -> "AnalysisNode":
+        child = AnalysisNode(self._source, node)
+        child._lines = self._lines
+        return child
 
-        finder = FindImports()
-        finder.visit(self._tree)
-        return set(found)
+    def _child(self, node: ast.AST) -> "AnalysisNode":
+        child = AnalysisNode(self._source, MarkerNode(node))
+        child._lines = self._lines
+        return child
+
+
+@dataclass
+class Facts:
+    """
+    An index of the facts about the root scope of a node. Counters map names
+    to the number of times they appear.
+    """
+
+    assignments: Counter = field(default_factory=Counter)
+    references: Counter = field(default_factory=Counter)
+    calls: Counter = field(default_factory=Counter)
+    constants: set = field(default_factory=set)
+    imports: set = field(default_factory=set)
+    tokens: Counter = field(default_factory=Counter)
+    functions: dict[str, ast.AST] = field(default_factory=dict)
+    classes: dict[str, ast.AST] = field(default_factory=dict)
+
+
+_definitions = (ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)
 
 
 class MarkerNode(ast.AST):
@@ -315,6 +314,55 @@ class MarkerNode(ast.AST):
         self.body = root.body
 
 
+class TreeView:
+    """
+    A read-only view of a parse tree that is made without copying the tree.
+    Attributes of the node are available as usual. Child nodes are returned as
+    views and lists of nodes as new lists of views. A view reports the class
+    of its node so it works with isinstance(), ast.walk() and
+    ast.NodeVisitor. Use copy() to get a tree that can be changed or compiled.
+    """
+
+    __slots__ = ("_node",)
+
+    def __init__(self, node: ast.AST):
+        object.__setattr__(self, "_node", node)
+
+    @property
+    def __class__(self) -> type:
+        return self._node.__class__
+
+    def __getattr__(self, name: str) -> typing.Any:
+        value = getattr(self._node, name)
+        if isinstance(value, ast.AST):
+            return TreeView(value)
+        elif isinstance(value, list):
+            return [
+                TreeView(x) if isinstance(x, ast.AST) else x for x in value
+            ]
+        return value
+
+    def __setattr__(self, name: str, value: typing.Any):
+        raise AttributeError(
+            f"The tree is read-only. Use copy() to change {name}."
+        )
+
+    def __delattr__(self, name: str):
+        raise AttributeError(
+            f"The tree is read-only. Use copy() to delete {name}."
+        )
+
+    def __repr__(self) -> str:
+        return f"TreeView({self._node!r})"
+
+    def __deepcopy__(self, memo: dict) -> ast.AST:
+        return copy.deepcopy(self._node, memo)
+
+    def copy(self) -> ast.AST:
+        """Return a deep copy of the tree that can be changed."""
+        return copy.deepcopy(self._node)
+
+
 class RootNodeFinder(ast.NodeVisitor):
     """
     A visitor that does not descend into class or function definitions.
@@ -328,3 +376,76 @@ class RootNodeFinder(ast.NodeVisitor):
 
     def visit_AsyncFunctionDef(self, node: ast.AsyncFunctionDef):
         pass
+
+
+class FactFinder(RootNodeFinder):
+    """
+    A visitor that gathers the Facts about a tree in a single pass. Like the
+    other finders it does not descend into class or function definitions, but
+    the parts of a definition outside of its body are counted as tokens.
+    """
+
+    def __init__(self):
+        self.facts = Facts()
+
+    def find(self, root: ast.AST) -> Facts:
+        """Visit the tree at `root` and return the facts."""
+        if root.__class__ == MarkerNode:
+            self.facts.tokens[root._real_node.__class__] += 1
+            self.count_header(root._real_node)
+            for node in root.body:
+                self.visit(node)
+        else:
+            self.visit(root)
+        return self.facts
+
+    def visit(self, node: ast.AST):
+        self.facts.tokens[node.__class__] += 1
+        return super().visit(node)
+
+    def count_header(self, node: ast.AST):
+        """Count the tokens in a definition, excluding the body."""
+        for name, value in ast.iter_fields(node):
+            if name != "body":
+                for child in value if isinstance(value, list) else [value]:
+                    if isinstance(child, ast.AST):
+                        self.facts.tokens.update(
+                            x.__class__ for x in ast.walk(child)
+                        )
+
+    def visit_ClassDef(self, node: ast.ClassDef):
+        self.facts.classes[node.name] = node
+        self.count_header(node)
+
+    def visit_FunctionDef(self, node: ast.FunctionDef):
+        self.facts.functions[node.name] = node
+        self.count_header(node)
+
+    def visit_AsyncFunctionDef(self, node: ast.AsyncFunctionDef):
+        self.visit_FunctionDef(node)
+
+    def visit_Name(self, node: ast.Name):
+        if isinstance(node.ctx, ast.Store):
+            self.facts.assignments[node.id] += 1
+        elif isinstance(node.ctx, ast.Load):
+            self.facts.references[node.id] += 1
+        self.generic_visit(node)
+
+    def visit_Constant(self, node: ast.Constant):
+        self.facts.constants.add(node.value)
+        self.generic_visit(node)
+
+    def visit_Call(self, node: ast.Call):
+        if isinstance(node.func, ast.Name):
+            self.facts.calls[node.func.id] += 1
+        elif isinstance(node.func, ast.Attribute):
+            self.facts.calls[node.func.attr] += 1
+        self.generic_visit(node)
+
+    def visit_Import(self, node: ast.Import):
+        self.facts.imports.update(alias.name for alias in node.names)
+        self.generic_visit(node)
+
+    def visit_ImportFrom(self, node: ast.ImportFrom):
+        self.facts.imports.add(node.module)
+        self.generic_visit(node)
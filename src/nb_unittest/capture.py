@@ -0,0 +1,99 @@
+"""
+Bounded capture of the output of a cell.
+"""
+
+import collections
+import io
+import tempfile
+from dataclasses import dataclass
+from typing import Union
+
+
+@dataclass(frozen=True)
+class CaptureLimits:
+    """
+    Limits on what run() keeps from a cell. A limit of `None` isn't enforced.
+
+    stream: The number of characters kept from each of stdout and stderr.
+        The first and last halves are kept and the middle is dropped.
+    outputs: The number of displayed objects kept.
+    spill: Also write everything printed to a temporary file, so that the
+        whole output can be read back when it's been truncated.
+    """
+
+    stream: Union[int, None] = 2**20
+    outputs: Union[int, None] = 1000
+    spill: bool = False
+
+
+class CappedOutput(io.TextIOBase):
+    """
+    A text stream that keeps the start and the end of what's written to it.
+    Writes past the start go into a ring buffer that holds the end.
+    """
+
+    def __init__(self, limit: Union[int, None] = None, spill: bool = False):
+        self.limit = limit
+        self.size = 0
+        self.file = tempfile.TemporaryFile("w+") if spill else None
+        self._head = io.StringIO()
+        self._head_size = 0
+        self._head_limit = None if limit is None else limit - limit // 2
+        self._tail = collections.deque()
+        self._tail_size = 0
+        self._tail_limit = 0 if limit is None else limit // 2
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, s: str) -> int:
+        n = len(s)
+        self.size += n
+        if self.file is not None:
+            self.file.write(s)
+
+        if self._head_limit is None:
+            part = s
+        else:
+            part = s[: max(self._head_limit - self._head_size, 0)]
+        if part:
+            self._head.write(part)
+            self._head_size += len(part)
+            s = s[len(part) :]
+        if not s or self._tail_limit == 0:
+            return n
+        if len(s) >= self._tail_limit:
+            self._tail.clear()
+            s = s[-self._tail_limit :]
+            self._tail_size = 0
+        self._tail.append(s)
+        self._tail_size += len(s)
+        while self._tail_size - len(self._tail[0]) >= self._tail_limit:
+            self._tail_size -= len(self._tail.popleft())
+        if self._tail_size > self._tail_limit:
+            excess = self._tail_size - self._tail_limit
+            self._tail[0] = self._tail[0][excess:]
+            self._tail_size -= excess
+        return n
+
+    @property
+    def truncated(self) -> bool:
+        """True if some of the output was dropped."""
+        return self.size > self._head_size + self._tail_size
+
+    def getvalue(self) -> str:
+        """
+        Return the kept output. A marker shows where output was dropped.
+        """
+        value = self._head.getvalue()
+        if self.truncated:
+            dropped = self.size - self._head_size - self._tail_size
+            value += f"\n[... {dropped} characters not captured ...]\n"
+        return value + "".join(self._tail)
+
+    def spilled(self) -> Union[io.TextIOBase, None]:
+        """Return the temporary file with all of the output, rewound."""
+        if self.file is not None:
+            self.file.flush()
+            self.file.seek(0)
+        return self.file
@@ -0,0 +1,55 @@
+"""
+A cache of compiled cells.
+"""
+
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+
+class CodeCache:
+    """
+    A least recently used cache of compiled code. Keys are built from the
+    hash of a cell's source and anything else that changes the compiled
+    result, such as the set of pushed names and the active AST transformers.
+    """
+
+    def __init__(self, maxsize: int = 256):
+        """
+        Create a cache that holds at most `maxsize` compiled cells.
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key: Hashable, build: Callable[[], Any]) -> Any:
+        """
+        Return the value cached under `key`. If there is no value, `build()`
+        is called to make one and the least recently used value is evicted if
+        the cache is full. Exceptions raised by `build()` are not cached.
+        """
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            value = build()
+            self._entries[key] = value
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        return value
+
+    def clear(self) -> None:
+        """Remove all of the cached values."""
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# Singleton instance.
+code_cache = CodeCache()
@@ -0,0 +1,318 @@
+"""
+Empirical complexity checks.
+
+The running time of a function is measured over a geometric series of input
+sizes and fit against the usual complexity classes. A check fails when the
+class that fits best grows faster than the class that's allowed. Timings are
+noisy, so the checks are good at telling O(n) from O(n^2) and not so good at
+telling O(n) from O(n log n). Allow some slack when choosing a bound.
+"""
+
+import gc
+import math
+import time
+import unittest
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterable, Union
+
+# Complexity classes from slowest to fastest growing. Aliases are accepted
+# in place of the names.
+CLASSES = {
+    "1": lambda n: 1.0,
+    "log n": lambda n: math.log(n),
+    "n": lambda n: float(n),
+    "n log n": lambda n: n * math.log(n),
+    "n^2": lambda n: float(n) ** 2,
+    "n^3": lambda n: float(n) ** 3,
+    "2^n": lambda n: 2.0 ** min(n, 64),
+}
+
+_aliases = {
+    "constant": "1",
+    "logn": "log n",
+    "log(n)": "log n",
+    "linear": "n",
+    "nlogn": "n log n",
+    "n log(n)": "n log n",
+    "n*log(n)": "n log n",
+    "n**2": "n^2",
+    "quadratic": "n^2",
+    "n**3": "n^3",
+    "cubic": "n^3",
+    "2**n": "2^n",
+    "exponential": "2^n",
+}
+
+# A simpler class is chosen over the best fit if its residual is no more
+# than fit_slack times the best residual plus fit_tolerance. Ties go to the
+# student.
+fit_slack = 1.5
+fit_tolerance = 0.05
+
+# Fits that grow less than this over the sizes that were timed are flat.
+flat_growth = 2
+
+
+@dataclass
+class Fit:
+    """
+    The fit of `time = constant + coefficient * f(n)` for a class. The
+    residual is the root mean square of the relative errors.
+    """
+
+    name: str
+    constant: float
+    coefficient: float
+    residual: float
+
+
+@dataclass
+class ComplexityResult:
+    """
+    The timings of a function and the fits of the complexity classes, best
+    fit first. `best` is the name of the class that was chosen.
+    """
+
+    sizes: list[int]
+    times: list[float]
+    fits: list[Fit] = field(default_factory=list)
+    best: Union[str, None] = None
+
+    def __str__(self) -> str:
+        return ", ".join(
+            f"n={n}: {_format_time(t)}" for n, t in zip(self.sizes, self.times)
+        )
+
+
+def complexity_class(name: str) -> str:
+    """Return the canonical name of a complexity class like "O(n log n)"."""
+    key = name.strip().lower()
+    if key.startswith("o(") and key.endswith(")"):
+        key = key[2:-1].strip()
+    key = _aliases.get(key.replace(" ", ""), key)
+    if key not in CLASSES:
+        raise ValueError(
+            f"""Unknown complexity class "{name}". Use one of: """
+            f"""{", ".join(CLASSES)}."""
+        )
+    return key
+
+
+def geometric_sizes(
+    start: int = 16, factor: float = 2, count: int = 8
+) -> list[int]:
+    """A geometric series of distinct input sizes."""
+    sizes = []
+    size = start
+    while len(sizes) < count:
+        if not sizes or int(size) > sizes[-1]:
+            sizes.append(int(size))
+        size *= factor
+    return sizes
+
+
+def measure(
+    function: Callable[[Any], Any],
+    make_input: Callable[[int], Any],
+    sizes: Iterable[int],
+    min_time: float = 0.01,
+    repeat: int = 3,
+    max_time: float = 0.5,
+    fresh: bool = False,
+) -> tuple[list[int], list[float]]:
+    """
+    Time `function(make_input(n))` for each size. Inputs are made before
+    timing starts. Each size gets a warm up call, then the number of calls
+    per repeat is doubled until a repeat takes at least `min_time` seconds.
+    The best time per call is kept. Larger sizes are skipped once a size
+    takes more than `max_time` seconds, so slow functions finish early.
+
+    The calls share one input unless `fresh` is True, then every call gets
+    a new input. Use it for functions that change their input, like an
+    in-place sort.
+
+    Returns the sizes that were timed and their times in seconds.
+    """
+    timed, times = [], []
+    for n in sizes:
+        function(make_input(n))
+        shared = None if fresh else make_input(n)
+        number = 1
+        while True:
+            best = min(
+                _time(function, make_input, n, number, shared)
+                for _ in range(repeat)
+            )
+            if best >= min_time or best * repeat >= max_time:
+                break
+            number *= 2
+        timed.append(n)
+        times.append(best / number)
+        if best * repeat >= max_time:
+            break
+    return timed, times
+
+
+def fit(sizes: list[int], times: list[float]) -> list[Fit]:
+    """
+    Fit the timings against each complexity class and return the fits,
+    best first. The fit is a least squares fit of the relative error, so
+    the small sizes count as much as the large ones.
+    """
+    fits = []
+    for name, f in CLASSES.items():
+        xs = [f(n) for n in sizes]
+        constant, coefficient = _linear_fit(xs, times)
+        residual = math.sqrt(
+            sum(
+                ((constant + coefficient * x - t) / t) ** 2
+                for x, t in zip(xs, times)
+            )
+            / len(times)
+        )
+        fits.append(Fit(name, constant, coefficient, residual))
+    fits.sort(key=lambda x: x.residual)
+    return fits
+
+
+def best_fit(fits: list[Fit], sizes: list[int]) -> str:
+    """
+    The simplest class that fits nearly as well as the best one. Flat
+    timings fit every class, which shouldn't count against a function, so a
+    fit that grows less than `flat_growth` times over the sizes counts as
+    O(1).
+    """
+    order = list(CLASSES)
+    best = fits[0].residual
+    good = []
+    for x in fits:
+        if x.residual > best * fit_slack + fit_tolerance:
+            continue
+        f = CLASSES[x.name]
+        first = x.constant + x.coefficient * f(sizes[0])
+        last = x.constant + x.coefficient * f(sizes[-1])
+        if first <= 0 or last < first * flat_growth:
+            good.append("1")
+        else:
+            good.append(x.name)
+    return min(good, key=order.index)
+
+
+def assert_complexity(
+    function: Any,
+    make_input: Callable[[int], Any],
+    max: str = "n",
+    sizes: Union[Iterable[int], None] = None,
+    min_time: float = 0.01,
+    repeat: int = 3,
+    max_time: float = 0.5,
+    fresh: bool = False,
+) -> ComplexityResult:
+    """
+    Fail if the running time of `function` grows faster than the class
+    `max`. For example, to check that a sort is better than O(n^2):
+
+        assert_complexity(my_sort, lambda n: random.sample(range(n), n),
+                          max="n log n")
+
+    function: A function that's called with one argument, a TagCacheEntry
+        or the tag of a cached cell. A cell is run with `make_input(n)`,
+        which must be a mapping, pushed into the notebook namespace.
+    make_input: A function that makes an input of size `n`.
+    max: The fastest growing class that's allowed, one of CLASSES.
+    sizes: The sizes to time. The default is 16, 32, ..., 2048.
+    min_time, repeat, max_time, fresh: See measure().
+
+    Returns the timings and fits. Raises AssertionError if the check fails.
+    """
+    allowed = complexity_class(max)
+    function = _callable(function)
+    if sizes is None:
+        sizes = geometric_sizes()
+    sizes, times = measure(
+        function, make_input, sizes, min_time, repeat, max_time, fresh
+    )
+    if len(sizes) < 3:
+        raise unittest.TestCase.failureException(
+            f"""Only {len(sizes)} input sizes finished in time, the growth """
+            f"""rate can't be measured. Timings: """
+            f"""{ComplexityResult(sizes, times)}."""
+        )
+    result = ComplexityResult(sizes, times, fit(sizes, times))
+    result.best = best_fit(result.fits, sizes)
+    order = list(CLASSES)
+    if order.index(result.best) > order.index(allowed):
+        raise unittest.TestCase.failureException(
+            f"""The running time grows like O({result.best}) but it should """
+            f"""grow no faster than O({allowed}). Timings: {result}."""
+        )
+    return result
+
+
+def _callable(function: Any) -> Callable[[Any], Any]:
+    from .tagcache import TagCacheEntry
+
+    if isinstance(function, str):
+        import nb_unittest
+
+        function = nb_unittest.get(function)
+
+    if isinstance(function, TagCacheEntry):
+        entry = function
+        return lambda push: entry.run(push, capture=False)
+
+    return function
+
+
+def _time(
+    function: Callable[[Any], Any],
+    make_input: Callable[[int], Any],
+    n: int,
+    number: int,
+    shared: Any = None,
+) -> float:
+    if shared is None:
+        inputs = [make_input(n) for _ in range(number)]
+    else:
+        inputs = [shared] * number
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        for x in inputs:
+            function(x)
+        return time.perf_counter() - start
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _linear_fit(xs: list[float], ys: list[float]) -> tuple[float, float]:
+    """
+    Fit y = a + b * x, weighting each point by 1 / y. The constant is the
+    overhead of a call and isn't allowed to be negative.
+    """
+    w = [1 / y**2 for y in ys]
+    sw = sum(w)
+    swx = sum(wi * x for wi, x in zip(w, xs))
+    swy = sum(wi * y for wi, y in zip(w, ys))
+    swxx = sum(wi * x * x for wi, x in zip(w, xs))
+    swxy = sum(wi * x * y for wi, x, y in zip(w, xs, ys))
+    det = sw * swxx - swx * swx
+    if det > 0:
+        b = (sw * swxy - swx * swy) / det
+        a = (swy - b * swx) / sw
+        if a >= 0:
+            return a, b
+    # Fit through the origin.
+    if swxx == 0:
+        return 0.0, 0.0
+    return 0.0, swxy / swxx
+
+
+def _format_time(seconds: float) -> str:
+    if seconds >= 1:
+        return f"{seconds:.2f} s"
+    elif seconds >= 1e-3:
+        return f"{seconds * 1e3:.2f} ms"
+    return f"{seconds * 1e6:.1f} µs"
@@ -0,0 +1,183 @@
+"""
+CPU profiles of student code.
+
+A sampling profiler looks at the stack of every thread each `sample_interval`
+seconds and charges the sample to the line of a cell that's running, even if
+the line is waiting for a function it called. The lines that got the most
+samples are the hotspots. Cells are recognized by their source, so the code
+that a cell defined is found wherever it's called from.
+"""
+
+import linecache
+import sys
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Iterable, Mapping, Union
+
+# Seconds between samples. Samples can be further apart because the
+# profiler has to wait its turn for the GIL.
+sample_interval = 0.002
+
+# The number of hotspots shown in the test report.
+top_hotspots = 5
+
+
+@dataclass(frozen=True)
+class Hotspot:
+    """
+    A line of a cell and the time spent running it.
+
+    cell: The name of the cell, usually its tag.
+    line: The line number in the cell, starting from 1.
+    source: The text of the line.
+    samples: The number of samples taken on the line.
+    time: An estimate of the seconds spent on the line.
+    """
+
+    cell: str
+    line: int
+    source: str
+    samples: int
+    time: float
+
+
+@dataclass
+class CPUProfile:
+    """
+    The time spent in cells while the profiler ran. `elapsed` is the
+    profiled time in seconds and `samples` is the number of samples taken,
+    including the ones outside of the cells. Hotspots are most samples first.
+    """
+
+    elapsed: float = 0.0
+    samples: int = 0
+    hotspots: list[Hotspot] = field(default_factory=list)
+
+    def top(self, count: Union[int, None] = None) -> list[Hotspot]:
+        """The hotspots with the most samples, `top_hotspots` by default."""
+        return self.hotspots[: top_hotspots if count is None else count]
+
+    def fraction(self, hotspot: Hotspot) -> float:
+        """The fraction of the samples that were taken on a hotspot."""
+        return hotspot.samples / self.samples if self.samples else 0.0
+
+    @classmethod
+    def merge(cls, profiles: Iterable["CPUProfile"]) -> "CPUProfile":
+        """
+        Add up profiles, for example from every submission of an assignment.
+        Hotspots are combined when they have the same cell and source, so
+        the same code counts together even if it moved to another line.
+        """
+        elapsed = 0.0
+        samples = 0
+        lines = {}
+        counts = Counter()
+        times = Counter()
+        for profile in profiles:
+            elapsed += profile.elapsed
+            samples += profile.samples
+            for spot in profile.hotspots:
+                key = (spot.cell, spot.source)
+                lines.setdefault(key, spot.line)
+                counts[key] += spot.samples
+                times[key] += spot.time
+        return cls(
+            elapsed,
+            samples,
+            [
+                Hotspot(key[0], lines[key], key[1], count, times[key])
+                for key, count in counts.most_common()
+            ],
+        )
+
+
+class CPUProfiler:
+    """
+    A context manager that profiles the cells while its `with` block runs.
+    `cells` maps the names of cells to their source. The profile is in
+    `profile` after the `with` block.
+    """
+
+    def __init__(self, cells: Mapping[str, str]):
+        self.profile = None
+        self._cells = {
+            _normalize(source): name for name, source in cells.items()
+        }
+        self._lines = {
+            name: source.splitlines() for name, source in cells.items()
+        }
+        self._files = {}
+        self._counts = Counter()
+        self._samples = 0
+        self._done = threading.Event()
+
+    def __enter__(self) -> "CPUProfiler":
+        self._start = time.perf_counter()
+        self._thread = threading.Thread(
+            target=self._sample_loop, name="nbtest profiler", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> bool:
+        self._done.set()
+        self._thread.join()
+        elapsed = time.perf_counter() - self._start
+        per_sample = elapsed / self._samples if self._samples else 0.0
+        self.profile = CPUProfile(
+            elapsed,
+            self._samples,
+            [
+                Hotspot(
+                    name,
+                    line,
+                    self._source(name, line),
+                    count,
+                    count * per_sample,
+                )
+                for (name, line), count in self._counts.most_common()
+            ],
+        )
+        return False
+
+    def _sample_loop(self) -> None:
+        while not self._done.wait(sample_interval):
+            self._samples += 1
+            me = threading.get_ident()
+            for ident, frame in sys._current_frames().items():
+                while ident != me and frame is not None:
+                    name = self._cell(frame.f_code.co_filename)
+                    if name is not None:
+                        # Frames that are starting have no line yet.
+                        if frame.f_lineno:
+                            self._counts[(name, frame.f_lineno)] += 1
+                        break
+                    frame = frame.f_back
+            # Don't keep the stacks alive until the next sample.
+            frame = None
+
+    def _cell(self, filename: str) -> Union[str, None]:
+        """The name of the cell that was compiled with `filename`."""
+        try:
+            return self._files[filename]
+        except KeyError:
+            pass
+        # IPython keeps the source of every cell it compiles in linecache,
+        # other files aren't read from disk.
+        entry = linecache.cache.get(filename)
+        name = None
+        if entry is not None and len(entry) == 4 and entry[1] is None:
+            name = self._cells.get("".join(entry[2]))
+        self._files[filename] = name
+        return name
+
+    def _source(self, name: str, line: int) -> str:
+        lines = self._lines[name]
+        return lines[line - 1].strip() if 0 < line <= len(lines) else ""
+
+
+def _normalize(source: str) -> str:
+    # The way IPython puts a cell's source in linecache.
+    return "".join(line + "\n" for line in source.splitlines())
@@ -0,0 +1,206 @@
+"""
+A dependency graph of executed cells and the %%testing cells that test them.
+
+A testing cell depends on the cells named by the tags on its magic line and
+on the cells that define the symbols named there. A cell depends on the
+cells that define the names it uses, anywhere in the cell, so a test of a
+function that calls a helper from another cell depends on that cell too.
+When a cell runs again the testing cells that depend on it, directly or
+through other cells, are affected. Untagged cells are in the graph too, for
+the names they define.
+"""
+
+import ast
+from dataclasses import dataclass
+from typing import Iterable, Union
+
+from .analysis import AnalysisNode
+
+
+@dataclass
+class TestCell:
+    """
+    A %%testing cell.
+
+    key: The cell's id.
+    line: The magic line, with the symbols and options.
+    source: The body of the cell.
+    names: The tags and symbols named on the magic line.
+    stale: True if a cell it depends on ran after it did.
+    """
+
+    key: str
+    line: str
+    source: str
+    names: frozenset[str]
+    stale: bool = False
+
+
+class DependencyGraph:
+    """
+    The cells that have run and the testing cells that depend on them. A
+    name is defined by the cell that defined it last, like it would be in
+    the notebook namespace. Cells are parsed when they're added. An untagged
+    cell is dropped once every name it defines was defined again by a later
+    cell, because nothing can depend on it then.
+    """
+
+    def __init__(self):
+        self.tests = {}
+        self._cells = {}
+        self._summaries = {}
+        # The cell with each tag and the cell that defines each name.
+        self._tags = {}
+        self._definers = {}
+
+    def add_cell(self, key: str, node: AnalysisNode) -> list[TestCell]:
+        """
+        Add a cell that ran, replacing the cell with the same key. The
+        testing cells that are affected are marked stale and returned.
+        """
+        if key in self._cells:
+            self._remove(key)
+        # Cells are kept in the order they last ran.
+        self._cells[key] = node
+        for tag in getattr(node, "tags", ()):
+            self._tags[tag] = key
+        for name in self._summary(key)[0]:
+            previous = self._definers.get(name)
+            self._definers[name] = key
+            if previous is not None and previous != key:
+                self._drop_unused(previous)
+        if self._drop_unused(key):
+            return []
+        affected = self.affected(key)
+        for test in affected:
+            test.stale = True
+        return affected
+
+    def add_test(
+        self, key: str, line: str, source: str, names: Iterable[str]
+    ) -> TestCell:
+        """Add a testing cell that ran, replacing the one with the same key."""
+        test = TestCell(key, line, source, frozenset(names))
+        self.tests.pop(key, None)
+        self.tests[key] = test
+        return test
+
+    def dependencies(self, test: TestCell) -> set[str]:
+        """The keys of the cells that a testing cell depends on."""
+        tags, definers = self._get_index()
+        todo = [
+            tags.get(name) if name.startswith("@") else definers.get(name)
+            for name in test.names
+        ]
+        found = set()
+        while todo:
+            key = todo.pop()
+            if key is None or key in found:
+                continue
+            found.add(key)
+            todo += [definers.get(name) for name in self._summary(key)[1]]
+        return found
+
+    def inputs(
+        self, test: TestCell
+    ) -> tuple[dict[str, AnalysisNode], set[str]]:
+        """
+        The cells a testing cell depends on, by key, and the names on its
+        line or used by those cells that no cell defines.
+        """
+        tags, definers = self._get_index()
+        keys = self.dependencies(test)
+        unresolved = {
+            name
+            for name in test.names
+            if name not in (tags if name.startswith("@") else definers)
+        }
+        for key in keys:
+            unresolved |= self._summary(key)[1] - definers.keys()
+        return {key: self._cells[key] for key in keys}, unresolved
+
+    def affected(self, key: str) -> list[TestCell]:
+        """The testing cells that depend on the cell `key`."""
+        return [
+            test
+            for test in self.tests.values()
+            if key in self.dependencies(test)
+        ]
+
+    def stale(
+        self, names: Union[Iterable[str], None] = None
+    ) -> list[TestCell]:
+        """
+        The stale testing cells. If `names` is given, the testing cells that
+        depend on the cells with those tags or that define those symbols
+        instead, stale or not.
+        """
+        if names is None:
+            return [test for test in self.tests.values() if test.stale]
+        tags, definers = self._get_index()
+        keys = {
+            tags.get(name) if name.startswith("@") else definers.get(name)
+            for name in names
+        }
+        return [
+            test
+            for test in self.tests.values()
+            if keys & self.dependencies(test)
+        ]
+
+    def _get_index(self) -> tuple[dict[str, str], dict[str, str]]:
+        return self._tags, self._definers
+
+    def _remove(self, key: str) -> None:
+        # Names the cell defined fall back to the last cell before it that
+        # defines them.
+        node = self._cells.pop(key)
+        defines = self._summaries.pop(key)[0]
+        tags = {
+            t for t in getattr(node, "tags", ()) if self._tags.get(t) == key
+        }
+        names = {n for n in defines if self._definers.get(n) == key}
+        for tag in tags:
+            del self._tags[tag]
+        for name in names:
+            del self._definers[name]
+        for other in reversed(self._cells):
+            if not (tags or names):
+                break
+            for tag in tags & set(getattr(self._cells[other], "tags", ())):
+                self._tags[tag] = other
+                tags.discard(tag)
+            for name in names & self._summaries[other][0]:
+                self._definers[name] = other
+                names.discard(name)
+
+    def _drop_unused(self, key: str) -> bool:
+        # Drop an untagged cell that no longer defines any name.
+        if getattr(self._cells[key], "tags", None):
+            return False
+        if any(self._definers.get(n) == key for n in self._summary(key)[0]):
+            return False
+        del self._cells[key]
+        del self._summaries[key]
+        return True
+
+    def _summary(self, key: str) -> tuple[set[str], set[str]]:
+        # The names a cell defines and the names it uses.
+        if key not in self._summaries:
+            node = self._cells[key]
+            try:
+                facts = node.facts
+                defines = (
+                    set(facts.assignments)
+                    | set(facts.functions)
+                    | set(facts.classes)
+                )
+                uses = {
+                    n.id
+                    for n in ast.walk(node._node)
+                    if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Load)
+                }
+            except SyntaxError:
+                defines, uses = set(), set()
+            self._summaries[key] = (defines, uses - defines)
+        return self._summaries[key]
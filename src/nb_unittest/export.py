@@ -0,0 +1,125 @@
+"""
+Machine-readable copies of test results.
+
+Results are written as they're produced, one notebook at a time, so a batch
+grader can keep a single results file for a whole assignment. JSON Lines files
+are opened for appending and can collect results from many runs. JUnit XML
+files hold the results of one run.
+"""
+
+import json
+import xml.etree.ElementTree as ET
+from dataclasses import asdict
+from pathlib import Path
+from typing import TextIO, Union
+
+from .unit import NotebookResult
+
+
+class _Writer:
+    """The shared handling of files for the writers."""
+
+    mode = "w"
+
+    def __init__(self, file: Union[str, Path, TextIO]):
+        if isinstance(file, (str, Path)):
+            self._file = open(file, self.mode, encoding="utf-8")
+            self._owned = True
+        else:
+            self._file = file
+            self._owned = False
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> bool:
+        self.close()
+        return False
+
+    def close(self) -> None:
+        self._closed = True
+        if self._owned:
+            self._file.close()
+        else:
+            self._file.flush()
+
+
+class JSONLinesWriter(_Writer):
+    """
+    Write one JSON object per test. Each object has the fields of a
+    TestRecord and the notebook the test came from.
+    """
+
+    mode = "a"
+
+    def write(
+        self, result: NotebookResult, notebook: Union[str, Path, None] = None
+    ) -> None:
+        """Write the records of a result and flush them to the file."""
+        for record in result.records:
+            line = {"notebook": None if notebook is None else str(notebook)}
+            line.update(asdict(record))
+            self._file.write(json.dumps(line) + "\n")
+        self._file.flush()
+
+
+class JUnitWriter(_Writer):
+    """
+    Write a JUnit XML document with a <testsuite> for each result. Failures
+    keep their severity in the `type` attribute. Tests that went over a
+    limit are errors with a type of "LimitExceeded".
+    """
+
+    def __init__(self, file: Union[str, Path, TextIO]):
+        super().__init__(file)
+        self._file.write('<?xml version="1.0" encoding="utf-8"?>\n')
+        self._file.write("<testsuites>\n")
+
+    def write(self, result: NotebookResult, name: Union[str, Path]) -> None:
+        """Write the records of a result as a test suite called `name`."""
+        records = result.records
+        outcomes = [record.outcome for record in records]
+        suite = ET.Element(
+            "testsuite",
+            name=str(name),
+            tests=str(len(records)),
+            failures=str(outcomes.count("failed")),
+            errors=str(
+                outcomes.count("error")
+                + outcomes.count("exceeded")
+                + outcomes.count("unexpected success")
+            ),
+            skipped=str(outcomes.count("skipped")),
+            time=f"{sum(r.duration or 0.0 for r in records):.6f}",
+        )
+        for record in records:
+            case = ET.SubElement(
+                suite,
+                "testcase",
+                classname=str(name),
+                name=record.test_id,
+                time=f"{record.duration or 0.0:.6f}",
+            )
+            if record.outcome == "failed":
+                tag, kind = "failure", record.severity
+            elif record.outcome in ("error", "unexpected success"):
+                tag, kind = "error", record.outcome
+            elif record.outcome == "exceeded":
+                tag, kind = "error", "LimitExceeded"
+            elif record.outcome == "skipped":
+                tag, kind = "skipped", None
+            else:
+                continue
+            element = ET.SubElement(case, tag, message=record.message or "")
+            if kind is not None:
+                element.set("type", kind)
+            element.text = record.name
+        ET.indent(suite, level=1)
+        self._file.write("  " + ET.tostring(suite, encoding="unicode") + "\n")
+        self._file.flush()
+
+    def close(self) -> None:
+        if not self._closed:
+            self._file.write("</testsuites>\n")
+        super().close()
@@ -0,0 +1,470 @@
+"""
+Headless batch grading of notebooks that use the %%testing magic.
+
+Notebooks are executed in an in-process InteractiveShell instead of a Jupyter
+kernel. Each worker process keeps one warm shell and resets it between
+notebooks, so grading a directory of submissions doesn't pay the cost of
+starting a kernel per file.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from pathlib import Path
+from typing import Iterable, Iterator, Union
+
+from IPython.core.interactiveshell import InteractiveShell
+
+import nb_unittest
+
+from . import tagcache
+from .cpu import CPUProfile
+from .export import JSONLinesWriter, JUnitWriter
+from .limits import LimitExceeded, Limits, Watchdog, parse_size
+from .memo import ResultMemo
+from .static import read_cells
+from .unit import NotebookResult
+
+_shell = None
+
+# The settings in nb_unittest.tagcache, put back after each notebook.
+_settings = (
+    "runner_class",
+    "show_timings",
+    "profile_tests",
+    "stream_results",
+    "result_budget",
+    "history_size",
+    "capture_limits",
+    "max_async_runs",
+    "auto_retest",
+    "result_memo",
+    "persist_path",
+)
+
+
+def find_notebooks(paths: Iterable[Union[str, Path]]) -> list[Path]:
+    """
+    Expand a list of notebook files and directories into a list of notebook
+    files. Directories are searched recursively, in sorted order, skipping
+    Jupyter's checkpoint directories.
+    """
+    found = []
+    for path in (Path(p) for p in paths):
+        if path.is_dir():
+            found += sorted(
+                p
+                for p in path.rglob("*.ipynb")
+                if ".ipynb_checkpoints" not in p.parts
+            )
+        else:
+            found.append(path)
+    return found
+
+
+def grade_notebook(
+    path: Union[str, Path],
+    limits: Union[Limits, None] = None,
+    test_limits: Union[Limits, None] = None,
+    profile: bool = False,
+    memo: Union[str, None] = None,
+) -> NotebookResult:
+    """
+    Execute a notebook and return the combined result of all of its %%testing
+    cells. Problems that prevent a test cell from running (e.g. missing
+    symbols) are reported as errors or failures of that cell, and exceptions
+    in other cells as errors or failures of "Cell N".
+
+    Modules that the notebook imports from its own directory are forgotten
+    afterwards, so they aren't seen by the next notebook, and the settings in
+    nb_unittest.tagcache that it changed are put back. Failures and errors
+    are kept as strings so the result can be sent between processes.
+
+    limits: Limits for running each cell of the notebook.
+    test_limits: Limits for running each test.
+    profile: Profile the tests. The hotspots are in the result's `profile`.
+    memo: A database of memoized test results. Testing cells whose inputs
+        haven't changed since their result was saved there don't run.
+    """
+    shell = _get_shell()
+    path = Path(path).resolve()
+    result = NotebookResult()
+
+    try:
+        cells = read_cells(path)
+    except (OSError, ValueError) as e:
+        result.addCellError(str(path), _exc_info(e))
+        return result
+
+    saved_cwd = os.getcwd()
+    saved_settings = {name: getattr(tagcache, name) for name in _settings}
+    saved_runner = tagcache.runner_class
+    saved_memo = tagcache.result_memo
+    tagcache.profile_tests = profile
+    if memo is not None:
+        tagcache.result_memo = ResultMemo(memo)
+    if limits or test_limits:
+        tagcache.runner_class = partial(
+            saved_runner, limits=limits, test_limits=test_limits
+        )
+    saved_path = list(sys.path)
+    saved_modules = set(sys.modules)
+    sys.path.insert(0, str(path.parent))
+    os.chdir(path.parent)
+    shell.reset(new_session=True)
+    try:
+        with (
+            contextlib.redirect_stdout(io.StringIO()),
+            contextlib.redirect_stderr(io.StringIO()),
+        ):
+            asyncio.run(_run_cells(shell, cells, result, limits))
+    finally:
+        shell.extension_manager.unload_extension("nb_unittest")
+        if tagcache.result_memo not in (saved_memo, None):
+            tagcache.result_memo.close()
+        for name, value in saved_settings.items():
+            setattr(tagcache, name, value)
+        os.chdir(saved_cwd)
+        sys.path[:] = saved_path
+        _forget_modules(saved_modules, path.parent)
+
+    _detach(result)
+    return result
+
+
+def grade(
+    paths: Iterable[Union[str, Path]],
+    jobs: int = 1,
+    limits: Union[Limits, None] = None,
+    test_limits: Union[Limits, None] = None,
+    profile: bool = False,
+    memo: Union[str, None] = None,
+) -> dict[Path, NotebookResult]:
+    """
+    Grade notebooks in parallel. `paths` may contain notebook files and
+    directories of notebooks. Returns a dictionary of notebook paths and their
+    results in the order the notebooks were found. A notebook that couldn't be
+    graded, because its worker crashed or its result couldn't be sent back,
+    has a result with one error.
+
+    jobs: The number of worker processes. When `jobs` is 1 notebooks are
+        graded in the current process.
+    limits: Limits for running each cell of a notebook.
+    test_limits: Limits for running each test.
+    profile: Profile the tests in each notebook.
+    memo: A database of memoized test results shared by the workers.
+    """
+    notebooks = find_notebooks(paths)
+    results = dict(
+        grade_iter(notebooks, jobs, limits, test_limits, profile, memo)
+    )
+    return {nb: results[nb] for nb in notebooks}
+
+
+def grade_iter(
+    paths: Iterable[Union[str, Path]],
+    jobs: int = 1,
+    limits: Union[Limits, None] = None,
+    test_limits: Union[Limits, None] = None,
+    profile: bool = False,
+    memo: Union[str, None] = None,
+) -> Iterator[tuple[Path, NotebookResult]]:
+    """
+    Like grade() but yield (path, result) tuples as soon as each notebook is
+    graded. With more than one job they come in the order the notebooks
+    finish.
+    """
+    notebooks = find_notebooks(paths)
+    run = partial(
+        grade_notebook,
+        limits=limits,
+        test_limits=test_limits,
+        profile=profile,
+        memo=memo,
+    )
+    if jobs == 1:
+        _get_shell()
+        for nb in notebooks:
+            try:
+                result = run(nb)
+            except Exception as e:
+                result = _failed(nb, e)
+            yield nb, result
+        return
+
+    # A worker that dies breaks the pool and every notebook that hadn't
+    # finished. They're graded again one at a time to find the one to blame.
+    broken = []
+    with _pool(jobs) as pool:
+        futures = {pool.submit(run, nb): nb for nb in notebooks}
+        for future in as_completed(futures):
+            nb = futures[future]
+            try:
+                yield nb, future.result()
+            except BrokenProcessPool:
+                broken.append(nb)
+            except Exception as e:
+                yield nb, _failed(nb, e)
+
+    for nb in broken:
+        with _pool(1) as pool:
+            try:
+                result = pool.submit(run, nb).result()
+            except Exception as e:
+                result = _failed(nb, e)
+        yield nb, result
+
+
+def main(argv: Union[list[str], None] = None) -> int:
+    """
+    The `nbtest` console command. Returns the exit status, 1 if a notebook
+    had a failure, an error or a test that went over a limit.
+    """
+    parser = argparse.ArgumentParser(
+        prog="nbtest",
+        description="Grade notebooks that use nb_unittest without Jupyter.",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    grade_parser = commands.add_parser(
+        "grade", help="Run the testing cells in notebooks and report results."
+    )
+    grade_parser.add_argument(
+        "paths", nargs="+", help="Notebook files or directories of notebooks."
+    )
+    grade_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="The number of notebooks to grade in parallel.",
+    )
+    for prefix, scope in (("", "test"), ("cell-", "cell")):
+        grade_parser.add_argument(
+            f"--{prefix}timeout",
+            type=float,
+            metavar="SECONDS",
+            help=f"The wall-clock time limit for each {scope}.",
+        )
+        grade_parser.add_argument(
+            f"--{prefix}cpu",
+            type=float,
+            metavar="SECONDS",
+            help=f"The CPU time limit for each {scope}.",
+        )
+        grade_parser.add_argument(
+            f"--{prefix}memory",
+            type=parse_size,
+            metavar="SIZE",
+            help=f"The memory limit for each {scope} (e.g. 100M).",
+        )
+    grade_parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="Show how long each test took.",
+    )
+    grade_parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Show where the tests spent their time across all notebooks.",
+    )
+    grade_parser.add_argument(
+        "--memo",
+        metavar="FILE",
+        help="Reuse the results of testing cells whose inputs are unchanged "
+        "since they were saved in FILE.",
+    )
+    grade_parser.add_argument(
+        "--jsonl",
+        metavar="FILE",
+        help="Append a JSON object for each test to FILE.",
+    )
+    grade_parser.add_argument(
+        "--junit",
+        metavar="FILE",
+        help="Write the results to FILE as JUnit XML.",
+    )
+    args = parser.parse_args(argv)
+
+    results = grade_iter(
+        args.paths,
+        jobs=args.jobs,
+        limits=Limits(args.cell_timeout, args.cell_cpu, args.cell_memory),
+        test_limits=Limits(args.timeout, args.cpu, args.memory),
+        profile=args.profile,
+        memo=args.memo,
+    )
+    profiles = []
+    status = 0
+    with contextlib.ExitStack() as stack:
+        writers = []
+        if args.jsonl:
+            writers.append(stack.enter_context(JSONLinesWriter(args.jsonl)))
+        if args.junit:
+            writers.append(stack.enter_context(JUnitWriter(args.junit)))
+        for path, result in results:
+            for writer in writers:
+                writer.write(result, path)
+            _report(path, result, args.timings)
+            if result.profile is not None:
+                profiles.append(result.profile)
+            if not result.wasSuccessful():
+                status = 1
+
+    if args.profile:
+        _report_profile(CPUProfile.merge(profiles))
+    return status
+
+
+def _report(path: Path, result: NotebookResult, timings: bool) -> None:
+    print(
+        f"{path}: {len(result.successes)} passed, "
+        f"{len(result.failures)} failed, {len(result.errors)} errors, "
+        f"{len(result.exceeded)} over limits"
+    )
+    if timings:
+        for timing in result.timings:
+            print(f"  {timing.total:8.3f}s  {timing.test_id}")
+
+
+def _report_profile(profile: CPUProfile) -> None:
+    print(f"Hotspots in {len(profile.hotspots)} lines:")
+    for spot in profile.top():
+        print(
+            f"  {profile.fraction(spot):6.1%}  {spot.cell}:{spot.line}  "
+            f"{spot.source}"
+        )
+
+
+def _get_shell() -> InteractiveShell:
+    global _shell
+    if _shell is None:
+        shell = InteractiveShell.instance()
+        if type(shell) is not InteractiveShell:
+            raise RuntimeError(
+                "Notebooks can't be graded inside of a running kernel."
+            )
+        _shell = shell
+    return _shell
+
+
+def _pool(jobs: int) -> ProcessPoolExecutor:
+    # Forked workers would inherit the shell of a kernel that calls grade().
+    return ProcessPoolExecutor(
+        max_workers=jobs, mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+async def _run_cells(
+    shell: InteractiveShell,
+    cells: list[tuple[str, str]],
+    result,
+    limits: Union[Limits, None],
+) -> None:
+    for number, (cell_id, source) in enumerate(cells, start=1):
+        try:
+            with Watchdog(limits, "cell"):
+                exec_result = shell.run_cell(
+                    source, store_history=True, cell_id=cell_id
+                )
+            error = exec_result.error_in_exec
+        except LimitExceeded as e:
+            error = e
+
+        header = source.lstrip().splitlines()[0] if source.strip() else ""
+        if isinstance(error, LimitExceeded):
+            # Any cell that runs away is reported, not just testing cells.
+            if not header.startswith("%%testing"):
+                header = f"Cell {number}"
+            result.addExceeded(header, error)
+            continue
+        if not header.startswith("%%testing"):
+            # The tests after a broken cell may still pass, but the
+            # notebook doesn't run cleanly.
+            error = error or exec_result.error_before_exec
+            if error is not None:
+                result.addCellError(f"Cell {number}", _exc_info(error))
+            continue
+
+        # Let asynchronous test runs finish before the next cell.
+        pending = asyncio.all_tasks() - {asyncio.current_task()}
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        cache = nb_unittest._cache
+        if cache is not None and cache.last_result is not None:
+            _merge(result, cache.last_result)
+        elif exec_result.error_in_exec is not None:
+            result.addCellError(header, _exc_info(exec_result.error_in_exec))
+        elif tagcache._last_error is not None:
+            result.addCellError(header, _exc_info(tagcache._last_error))
+
+
+def _merge(result: NotebookResult, other) -> None:
+    """Add the outcomes of one test run to a notebook's result."""
+
+    def name(test) -> str:
+        # Other runners record test instances, which may not be picklable.
+        return test if isinstance(test, str) else str(test)
+
+    result.testsRun += other.testsRun
+    result.successes += [name(t) for t in getattr(other, "successes", [])]
+    result.failures += [(name(t), e) for t, e in other.failures]
+    result.errors += [(name(t), e) for t, e in other.errors]
+    result.skipped += [(name(t), r) for t, r in other.skipped]
+    result.expectedFailures += [
+        (name(t), e) for t, e in other.expectedFailures
+    ]
+    result.unexpectedSuccesses += [name(t) for t in other.unexpectedSuccesses]
+    result.exceeded += getattr(other, "exceeded", [])
+    result.timings += getattr(other, "timings", [])
+    result.records += getattr(other, "records", [])
+    profiles = [
+        p for p in (result.profile, getattr(other, "profile", None)) if p
+    ]
+    if profiles:
+        result.profile = CPUProfile.merge(profiles)
+
+
+def _detach(result: NotebookResult) -> None:
+    """
+    Replace the exceptions in a result with their messages. An exception can
+    hold objects of classes that were defined in the notebook, which can't be
+    unpickled anywhere else.
+    """
+    result.failures = [(name, str(e)) for name, e in result.failures]
+    result.errors = [(name, str(e)) for name, e in result.errors]
+    result.expectedFailures = [
+        (name, str(e)) for name, e in result.expectedFailures
+    ]
+
+
+def _forget_modules(before: set[str], directory: Path) -> None:
+    """Remove the modules that were imported from `directory`."""
+    for name in set(sys.modules) - before:
+        module = sys.modules.get(name)
+        locations = [getattr(module, "__file__", None)]
+        locations += list(getattr(module, "__path__", None) or [])
+        if any(
+            loc and Path(loc).resolve().is_relative_to(directory)
+            for loc in locations
+        ):
+            del sys.modules[name]
+
+
+def _failed(path: Path, e: BaseException) -> NotebookResult:
+    """The result of a notebook that couldn't be graded."""
+    result = NotebookResult()
+    result.addCellError(str(path), _exc_info(e))
+    _detach(result)
+    return result
+
+
+def _exc_info(e: BaseException) -> tuple:
+    return (type(e), e, e.__traceback__)
@@ -0,0 +1,271 @@
+"""
+Time and memory limits for running tests.
+
+Limits are enforced by a watchdog thread that checks a running test and raises
+LimitExceeded in the thread that runs it. Like KeyboardInterrupt the exception
+arrives between Python bytecodes, so a test that's blocked in a system call is
+stopped when the call returns.
+"""
+
+import asyncio
+import contextvars
+import re
+import threading
+import time
+import tracemalloc
+from dataclasses import dataclass, fields, replace
+from typing import Any, Awaitable, Union
+
+from .memory import _start_tracing, _stop_tracing
+
+# How often the watchdog checks a test, in seconds.
+_interval = 0.01
+
+# How long to wait before raising again in code that caught the exception.
+_grace = 1.0
+
+# The watchdogs in effect in the current thread or task.
+_active = contextvars.ContextVar("_active", default=())
+
+
+class LimitExceeded(BaseException):
+    """
+    Raised in a test that goes over a limit. It's not an Exception so that
+    student code can't accidentally catch it with `except Exception`.
+    """
+
+    message = "A limit was exceeded."
+
+    def __str__(self) -> str:
+        return self.message
+
+
+@dataclass(frozen=True)
+class Limits:
+    """
+    Limits for a test or a cell of tests. A limit of `None` isn't enforced.
+
+    timeout: Wall-clock time in seconds.
+    cpu: CPU time in seconds used by the thread that runs the test.
+    memory: Bytes of memory allocated by Python, as measured by tracemalloc.
+        tracemalloc measures the whole process, so tests that run at the same
+        time in threads count against each other's memory limits.
+    """
+
+    timeout: Union[float, None] = None
+    cpu: Union[float, None] = None
+    memory: Union[int, None] = None
+
+    def __bool__(self) -> bool:
+        return any(getattr(self, f.name) is not None for f in fields(self))
+
+    def update(self, other: "Limits") -> "Limits":
+        """Return a copy of these limits with the limits set in `other`."""
+        return replace(
+            self,
+            **{
+                f.name: getattr(other, f.name)
+                for f in fields(other)
+                if getattr(other, f.name) is not None
+            },
+        )
+
+
+def parse_size(value: str) -> int:
+    """
+    Convert a size like "512K", "100M" or "1G" into a number of bytes. Sizes
+    without a suffix are in bytes.
+    """
+    m = re.match(r"^(\d+(?:\.\d+)?)([KMG]?)B?$", value.strip().upper())
+    if m is None:
+        raise ValueError(f"""Bad memory size "{value}".""")
+    scale = {"": 1, "K": 2**10, "M": 2**20, "G": 2**30}[m.group(2)]
+    return int(float(m.group(1)) * scale)
+
+
+class Watchdog:
+    """
+    A context manager that enforces limits on the code in its `with` block.
+
+    Synchronous code is stopped by raising LimitExceeded in its thread. In a
+    coroutine pass the running loop. Coroutines awaited with wait() run in
+    their own tasks and are cancelled if the limit runs out while they're
+    waiting. When they're running the exception is raised in the loop's
+    thread instead.
+    """
+
+    def __init__(
+        self,
+        limits: Union[Limits, None],
+        scope: str = "test",
+        loop: Union[asyncio.AbstractEventLoop, None] = None,
+    ):
+        self.limits = limits
+        self.scope = scope
+        self.loop = loop
+        self.exceeded = None
+        self._tasks = set()
+        self._waiting = []
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._cancel_pending = False
+        self._next_raise = 0
+        self._raised = 0
+        self._traced = False
+
+    def __enter__(self) -> "Watchdog":
+        if not self.limits:
+            return self
+
+        self._ident = threading.get_ident()
+        if hasattr(time, "pthread_getcpuclockid"):
+            clock = time.pthread_getcpuclockid(self._ident)
+            self._cpu_time = lambda: time.clock_gettime(clock)
+        else:
+            self._cpu_time = time.process_time
+        self._start = time.monotonic()
+        self._cpu_start = self._cpu_time()
+        if self.limits.memory is not None:
+            self._traced = _start_tracing()
+            self._memory_start = tracemalloc.get_traced_memory()[0]
+        if self.loop is not None:
+            self._tasks.add(asyncio.current_task(self.loop))
+
+        self._token = _active.set(_active.get() + (self,))
+        self._thread = threading.Thread(
+            target=self._watch, name="nbtest watchdog", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> bool:
+        if not self.limits:
+            return False
+
+        try:
+            with self._lock:
+                self._done.set()
+                _set_async_exc(self._ident, None)
+        finally:
+            self._thread.join()
+            _active.reset(self._token)
+            if self._traced:
+                _stop_tracing()
+        return False
+
+    async def wait(self, aw: Awaitable) -> Any:
+        """Await `aw` in a task that's cancelled if a limit runs out."""
+        if not _active.get():
+            return await aw
+
+        task = asyncio.ensure_future(aw)
+        for dog in _active.get():
+            dog._tasks.add(task)
+            dog._waiting.append(task)
+        try:
+            return await task
+        except asyncio.CancelledError:
+            for dog in _active.get():
+                if dog.exceeded is not None and task.cancelled():
+                    raise dog.exceeded from None
+            raise
+
+    def _check(self) -> Union[type, None]:
+        limits = self.limits
+        if (
+            limits.timeout is not None
+            and time.monotonic() - self._start > limits.timeout
+        ):
+            return self._error(
+                f"The {self.scope} ran for more than {limits.timeout:g} "
+                "seconds."
+            )
+        if (
+            limits.cpu is not None
+            and self._cpu_time() - self._cpu_start > limits.cpu
+        ):
+            return self._error(
+                f"The {self.scope} used more than {limits.cpu:g} seconds of "
+                "CPU time."
+            )
+        if (
+            limits.memory is not None
+            and tracemalloc.get_traced_memory()[0] - self._memory_start
+            > limits.memory
+        ):
+            size = _format_size(limits.memory)
+            return self._error(
+                f"The {self.scope} used more than {size} of memory."
+            )
+        return None
+
+    def _error(self, message: str) -> type:
+        # Only exception classes can be raised in another thread, so the
+        # message is stored on a subclass.
+        return type(
+            LimitExceeded.__name__, (LimitExceeded,), {"message": message}
+        )
+
+    def _watch(self) -> None:
+        while not self._done.wait(_interval):
+            if self.exceeded is None:
+                self.exceeded = self._check()
+            if (
+                self.exceeded is not None
+                and time.monotonic() >= self._next_raise
+            ):
+                with self._lock:
+                    if self._done.is_set():
+                        return
+                    self._raise()
+
+    def _raise(self) -> None:
+        if self.loop is None:
+            _set_async_exc(self._ident, self.exceeded)
+            self._next_raise = time.monotonic() + _grace
+        elif not self._cancel_pending:
+            self._cancel_pending = True
+            self.loop.call_soon_threadsafe(self._cancel, self._raised)
+        elif asyncio.current_task(self.loop) in self._tasks:
+            # The loop is stuck running the test.
+            _set_async_exc(self._ident, self.exceeded)
+            self._raised += 1
+            self._next_raise = time.monotonic() + _grace
+
+    def _cancel(self, raised: int) -> None:
+        self._cancel_pending = False
+        if self._done.is_set() or raised != self._raised:
+            return
+        self._next_raise = time.monotonic() + _grace
+        for task in reversed(self._waiting):
+            if not task.done():
+                task.cancel()
+                break
+
+
+def exceeded() -> Union[type, None]:
+    """
+    The LimitExceeded of the innermost watchdog in effect that ran out, or
+    None if none of them did.
+    """
+    for dog in reversed(_active.get()):
+        if dog.exceeded is not None:
+            return dog.exceeded
+    return None
+
+
+def _set_async_exc(ident: int, exc: Union[type, None]) -> None:
+    import ctypes  # Only needed when limits are set.
+
+    # A NULL exception clears one that hasn't been raised yet.
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(
+        ctypes.c_ulong(ident),
+        ctypes.py_object() if exc is None else ctypes.py_object(exc),
+    )
+
+
+def _format_size(size: int) -> str:
+    for unit, scale in (("GB", 2**30), ("MB", 2**20), ("KB", 2**10)):
+        if size >= scale:
+            return f"{size / scale:g} {unit}"
+    return f"{size} bytes"
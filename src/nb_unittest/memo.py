@@ -0,0 +1,200 @@
+"""
+Memoized results of %%testing cells.
+
+A testing cell's result is kept under a key made from the cell, its magic
+line, the test runner and the source of every cell it depends on. When the
+cell runs again and none of them changed the result is shown without running
+the tests. Names that the cells use but that no cell defines must be modules,
+or functions or classes that come from modules, otherwise a change to them
+couldn't be seen and the result isn't memoized. Modules that aren't installed,
+like a helper.py next to the notebook, are known by their file and a hash of
+its contents.
+
+Results are stored with pickle, so only load memo files you trust.
+"""
+
+import hashlib
+import os
+import pickle
+import sqlite3
+import sys
+import sysconfig
+import types
+import warnings
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Mapping, Union
+
+from .depgraph import DependencyGraph, TestCell
+
+if TYPE_CHECKING:
+    from .unit import NotebookResult
+
+# The kinds of values that are identified by their module and name.
+_definitions = (type, types.FunctionType, types.BuiltinFunctionType)
+
+# Modules under these directories are identified by their name alone.
+_installed = tuple(
+    os.path.join(os.path.realpath(path), "")
+    for path in {
+        sysconfig.get_path(name)
+        for name in ("stdlib", "platstdlib", "purelib", "platlib")
+    }
+)
+
+# File hashes by path, with the modification time and size they were for.
+_hashes = {}
+
+_schema = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    result BLOB NOT NULL
+);
+"""
+
+
+class ResultMemo:
+    """
+    A store of test results by key. Results are kept in memory, least
+    recently used first out, unless there's a `path`, then they're kept in an
+    SQLite database that's shared by every process that opens it.
+
+    path: The database file. It's created if it doesn't exist.
+    max_entries: The number of results kept in memory.
+    """
+
+    def __init__(self, path: Union[str, None] = None, max_entries: int = 256):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._results = OrderedDict()
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path)
+            self._db.executescript(_schema)
+
+    def get(self, key: str) -> Union["NotebookResult", None]:
+        """Return a copy of the result saved under `key` or None."""
+        data = self._load(key)
+        if data is not None:
+            try:
+                result = pickle.loads(data)
+            except Exception:
+                # The class of an error may not be defined yet.
+                result = None
+            if result is not None:
+                self.hits += 1
+                return result
+        self.misses += 1
+        return None
+
+    def put(self, key: str, result: "NotebookResult") -> None:
+        """Save a copy of a result under `key`."""
+        try:
+            data = pickle.dumps(result)
+        except Exception as e:
+            # Errors in the result can hold anything.
+            warnings.warn(f"The test result wasn't memoized: {e}")
+            return
+        if self._db is not None:
+            try:
+                with self._db:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO results VALUES (?, ?)",
+                        (key, data),
+                    )
+            except sqlite3.Error as e:
+                warnings.warn(f"The test result wasn't memoized: {e}")
+            return
+        self._results[key] = data
+        self._results.move_to_end(key)
+        while len(self._results) > self.max_entries:
+            self._results.popitem(last=False)
+
+    def clear(self) -> None:
+        """Forget every result."""
+        self._results.clear()
+        if self._db is not None:
+            with self._db:
+                self._db.execute("DELETE FROM results")
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+
+    def _load(self, key: str) -> Union[bytes, None]:
+        if self._db is not None:
+            row = self._db.execute(
+                "SELECT result FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            return row and row[0]
+        data = self._results.get(key)
+        if data is not None:
+            self._results.move_to_end(key)
+        return data
+
+
+def memo_key(
+    test: TestCell,
+    graph: DependencyGraph,
+    namespace: Mapping[str, Any],
+    runner: Any,
+) -> Union[str, None]:
+    """
+    The key of a testing cell's result, or None if the result can't be
+    memoized because the cell depends on something that isn't tracked.
+    `namespace` is the notebook namespace and `runner` the test runner class.
+    """
+    cells, unresolved = graph.inputs(test)
+    parts = [test.line, test.source, repr(runner)]
+    parts += sorted(cell.source_hash for cell in cells.values())
+    for name in sorted(unresolved):
+        if name.startswith("@"):
+            return None
+        if name not in namespace:
+            # A builtin, or a NameError every time.
+            continue
+        value = namespace[name]
+        if isinstance(value, types.ModuleType):
+            module = _module_id(value)
+            if module is None:
+                return None
+            parts.append(f"{name}={module}")
+            continue
+        # Other values that no cell defines, like one that run() pushed, can
+        # change without a cell being seen to change.
+        if not isinstance(value, _definitions):
+            return None
+        module = getattr(value, "__module__", None)
+        if not isinstance(module, str) or module == "__main__":
+            return None
+        module = _module_id(sys.modules.get(module))
+        if module is None:
+            return None
+        parts.append(f"{name}={module}.{value.__qualname__}")
+    return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+
+def _module_id(module: Union[types.ModuleType, None]) -> Union[str, None]:
+    """
+    The name of an installed or built-in module, or the name, file and
+    content hash of any other module. None if the module can't be found.
+    """
+    if module is None:
+        return None
+    path = getattr(module, "__file__", None)
+    if path is None:
+        return module.__name__
+    path = os.path.realpath(path)
+    if path.startswith(_installed):
+        return module.__name__
+    try:
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        if path not in _hashes or _hashes[path][0] != version:
+            with open(path, "rb") as fh:
+                digest = hashlib.sha256(fh.read()).hexdigest()
+            _hashes[path] = (version, digest)
+    except OSError:
+        return None
+    return f"{module.__name__}:{path}:{_hashes[path][1]}"
@@ -0,0 +1,150 @@
+"""
+Memory profiles of cell runs.
+
+Allocations are measured with tracemalloc, which only sees memory allocated
+by Python. Allocation sites are the lines of the cell that allocated memory
+that was still in use when the run finished. Memory allocated by functions
+that the cell calls counts against the line of the cell that called them.
+"""
+
+import linecache
+import threading
+import tracemalloc
+from collections import Counter
+from dataclasses import dataclass, field
+
+# The number of frames to keep for each allocation when profiling starts
+# tracemalloc. Allocations that are more frames away from the cell can't be
+# traced back to a line.
+traceback_limit = 10
+
+# The number of allocation sites to keep in a profile.
+top_sites = 10
+
+# The number of profilers and watchdogs using the tracemalloc that they
+# started. It's stopped when the last one is done.
+_tracers = 0
+_tracers_lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class AllocationSite:
+    """
+    A line of a cell that allocated memory.
+
+    line: The line number in the cell, starting from 1.
+    source: The text of the line.
+    size: The bytes allocated by the line that were still in use.
+    count: The number of memory blocks.
+    """
+
+    line: int
+    source: str
+    size: int
+    count: int
+
+
+@dataclass
+class MemoryProfile:
+    """
+    The memory used by a run of a cell.
+
+    peak: The most memory in use during the run, in bytes, over what was in
+        use when the run started.
+    net: The bytes still in use after the run that weren't before.
+    sites: The lines that hold the most memory after the run, largest
+        first.
+    """
+
+    peak: int = 0
+    net: int = 0
+    sites: list[AllocationSite] = field(default_factory=list)
+
+
+class MemoryProfiler:
+    """
+    A context manager that profiles the memory used by the code in its
+    `with` block. `filename` is the name the cell was compiled with. The
+    profile is in `profile` after the block.
+
+    tracemalloc is started if it isn't running and stopped again afterwards,
+    unless a watchdog still uses it. If it's already running its traceback
+    limit is used, and memory that lines of the same cell allocated before
+    the block and still hold is in the sites too.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.profile = None
+        self._started = False
+
+    def __enter__(self) -> "MemoryProfiler":
+        self._started = _start_tracing(traceback_limit)
+        tracemalloc.reset_peak()
+        self._start = tracemalloc.get_traced_memory()[0]
+        return self
+
+    def __exit__(self, *exc_info) -> bool:
+        current, peak = tracemalloc.get_traced_memory()
+        try:
+            sizes, counts = self._sites(tracemalloc.take_snapshot())
+        finally:
+            if self._started:
+                _stop_tracing()
+        sites = [
+            AllocationSite(
+                line,
+                linecache.getline(self.filename, line).strip(),
+                size,
+                counts[line],
+            )
+            for line, size in sizes.most_common(top_sites)
+            if size > 0
+        ]
+        self.profile = MemoryProfile(
+            peak=max(peak - self._start, 0),
+            net=current - self._start,
+            sites=sites,
+        )
+        return False
+
+    def _sites(
+        self, snapshot: tracemalloc.Snapshot
+    ) -> tuple[Counter, Counter]:
+        """The bytes and blocks held by each line of the cell."""
+        sizes = Counter()
+        counts = Counter()
+        # Every allocation with the same traceback is counted at once.
+        for stat in snapshot.statistics("traceback"):
+            # Frames are oldest first, find the cell's innermost frame.
+            for frame in reversed(stat.traceback):
+                if frame.filename == self.filename:
+                    sizes[frame.lineno] += stat.size
+                    counts[frame.lineno] += stat.count
+                    break
+        return sizes, counts
+
+
+def _start_tracing(frames: int = 1) -> bool:
+    """
+    Start tracemalloc with `frames` frames per allocation, or share it if a
+    watchdog or profiler started it. Returns False if something else started
+    it, then it's not stopped with _stop_tracing().
+    """
+    global _tracers
+    with _tracers_lock:
+        if _tracers == 0:
+            if tracemalloc.is_tracing():
+                return False
+            tracemalloc.start(frames)
+        _tracers += 1
+        return True
+
+
+def _stop_tracing() -> None:
+    """Stop tracemalloc if nothing else that started it is using it."""
+    global _tracers
+    with _tracers_lock:
+        _tracers -= 1
+        if _tracers == 0:
+            tracemalloc.stop()
@@ -0,0 +1,157 @@
+"""
+Structural patterns for searching parse trees.
+
+A pattern is written like the node it matches, using the class names from the
+ast module:
+
+    For(iter=Call(func=Name('range')))
+
+Positional arguments match the node's fields in order, so `Name('range')` is
+`Name(id='range')`. Other values in a pattern are:
+
+    _               Anything.
+    expr, stmt      A node class without arguments matches any node of that
+                    class, including subclasses.
+    'x', 1, True    A constant matches an equal value of the same type.
+    [p, q]          A list matches a list with matching items.
+    p               Any other pattern given for a list field matches if one of
+                    the items in the list matches.
+    p | q           Either pattern.
+    p & q           Both patterns.
+    ~p              Anything that doesn't match.
+    Has(p)          A node with a descendant that matches.
+
+Patterns are compiled once into functions and cached.
+"""
+
+import ast
+import functools
+from dataclasses import dataclass
+from typing import Any, Callable
+
+
+@dataclass(frozen=True)
+class Pattern:
+    """
+    A compiled pattern.
+
+    types: The node classes that a match can have. Only nodes of these
+        classes need to be tested.
+    test: A function that returns True if a node matches.
+    """
+
+    text: str
+    types: tuple[type, ...]
+    test: Callable[[ast.AST], bool]
+
+    def __call__(self, node: ast.AST) -> bool:
+        return self.test(node)
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_pattern(text: str) -> Pattern:
+    """Compile the text of a pattern. Raises ValueError if it's invalid."""
+    try:
+        tree = ast.parse(text.strip(), mode="eval").body
+    except SyntaxError as e:
+        raise ValueError(f"""Bad pattern "{text}": {e.msg}.""") from None
+    types, test = _compile(tree, text)
+    return Pattern(text, types, test)
+
+
+def _compile(
+    expr: ast.expr, text: str
+) -> tuple[tuple[type, ...], Callable[[Any], bool]]:
+    if isinstance(expr, ast.Name):
+        if expr.id == "_":
+            return (ast.AST,), lambda node: True
+        cls = _node_class(expr.id, text)
+        return (cls,), lambda node: isinstance(node, cls)
+
+    elif isinstance(expr, ast.Call) and isinstance(expr.func, ast.Name):
+        if expr.func.id == "Has":
+            if len(expr.args) != 1 or expr.keywords:
+                raise ValueError(f"""Has() takes one pattern in "{text}".""")
+            _, inner = _compile(expr.args[0], text)
+
+            def has(node):
+                return isinstance(node, ast.AST) and any(
+                    inner(child)
+                    for child in ast.walk(node)
+                    if child is not node
+                )
+
+            return (ast.AST,), has
+
+        cls = _node_class(expr.func.id, text)
+        if len(expr.args) > len(cls._fields):
+            raise ValueError(
+                f"""Too many arguments for {cls.__name__} in "{text}"."""
+            )
+        checks = [
+            (name, _value(arg, text))
+            for name, arg in zip(cls._fields, expr.args)
+        ]
+        for keyword in expr.keywords:
+            if keyword.arg not in cls._fields:
+                raise ValueError(
+                    f"""{cls.__name__} has no field "{keyword.arg}" in """
+                    f""""{text}"."""
+                )
+            checks.append((keyword.arg, _value(keyword.value, text)))
+
+        def test(node):
+            return isinstance(node, cls) and all(
+                check(getattr(node, name, None)) for name, check in checks
+            )
+
+        return (cls,), test
+
+    elif isinstance(expr, ast.BinOp) and isinstance(expr.op, ast.BitOr):
+        left_types, left = _compile(expr.left, text)
+        right_types, right = _compile(expr.right, text)
+        return left_types + right_types, lambda node: left(node) or right(node)
+
+    elif isinstance(expr, ast.BinOp) and isinstance(expr.op, ast.BitAnd):
+        left_types, left = _compile(expr.left, text)
+        right_types, right = _compile(expr.right, text)
+        types = right_types if left_types == (ast.AST,) else left_types
+        return types, lambda node: left(node) and right(node)
+
+    elif isinstance(expr, ast.UnaryOp) and isinstance(expr.op, ast.Invert):
+        _, inner = _compile(expr.operand, text)
+        return (ast.AST,), lambda node: not inner(node)
+
+    raise ValueError(
+        f"""Unsupported pattern "{ast.unparse(expr)}" in "{text}"."""
+    )
+
+
+def _value(expr: ast.expr, text: str) -> Callable[[Any], bool]:
+    """Compile the pattern for the value of a field."""
+    if isinstance(expr, ast.Name) and expr.id == "_":
+        return lambda x: True
+
+    elif isinstance(expr, ast.Constant):
+        value = expr.value
+        return lambda x: type(x) is type(value) and x == value
+
+    elif isinstance(expr, ast.List):
+        items = [_value(item, text) for item in expr.elts]
+        return lambda x: (
+            isinstance(x, list)
+            and len(x) == len(items)
+            and all(item(y) for item, y in zip(items, x))
+        )
+
+    _, test = _compile(expr, text)
+    return lambda x: (
+        any(test(y) for y in x) if isinstance(x, list) else test(x)
+    )
+
+
+def _node_class(name: str, text: str) -> type:
+    cls = getattr(ast, name, None)
+    if not (isinstance(cls, type) and issubclass(cls, ast.AST)):
+        raise ValueError(f"""Unknown node type "{name}" in "{text}".""")
+    return cls
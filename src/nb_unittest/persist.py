@@ -0,0 +1,173 @@
+"""
+A persistent copy of the tag cache that survives kernel restarts.
+"""
+
+import atexit
+import pickle
+import sqlite3
+import warnings
+from typing import Iterable, Iterator, Union
+
+from IPython.core.interactiveshell import (
+    ExecutionInfo,
+    ExecutionResult,
+    InteractiveShell,
+)
+
+_schema = """
+CREATE TABLE IF NOT EXISTS cells (
+    cell_id TEXT NOT NULL,
+    source_hash TEXT NOT NULL,
+    raw_cell TEXT NOT NULL,
+    execution_count INTEGER,
+    result BLOB,
+    facts BLOB,
+    PRIMARY KEY (cell_id, source_hash)
+);
+CREATE TABLE IF NOT EXISTS tags (
+    tag TEXT PRIMARY KEY,
+    cell_id TEXT NOT NULL,
+    source_hash TEXT NOT NULL
+);
+"""
+
+
+class TagDatabase:
+    """
+    An SQLite database of tagged cells. Cells are keyed by cell id and source
+    hash and keep their source, their analysis facts and the value of their
+    result if it can be pickled.
+
+    Results are stored with pickle, so only load databases you trust.
+
+    Saving a cell only queues it, so running a cell doesn't wait for its
+    result to be measured and pickled. Queued cells are written by flush(),
+    which runs when the database is closed or the interpreter exits.
+
+    path: The database file. It's created if it doesn't exist.
+    max_result_bytes: Results that are estimated to be larger than this
+        aren't saved.
+    """
+
+    def __init__(self, path: str, max_result_bytes: int = 16 * 2**20):
+        self.path = path
+        self.max_result_bytes = max_result_bytes
+        self._db = sqlite3.connect(path)
+        self._db.executescript(_schema)
+        # The entries to write, oldest first.
+        self._unsaved = {}
+        atexit.register(self.close)
+
+    def save(self, entry) -> None:
+        """Queue a cache entry to be saved under each of its tags."""
+        self._unsaved.pop(entry, None)
+        self._unsaved[entry] = None
+
+    def flush(self, entry=None) -> None:
+        """
+        Write the queued entries, or only `entry` if it's queued. Entries
+        whose tags all belong to newer entries are dropped without being
+        written.
+        """
+        if entry is not None:
+            if entry in self._unsaved:
+                del self._unsaved[entry]
+                self._write([entry])
+            return
+        claimed = set()
+        entries = []
+        for queued in reversed(self._unsaved):
+            if not claimed.issuperset(queued.tags):
+                entries.append(queued)
+                claimed.update(queued.tags)
+        self._unsaved.clear()
+        self._write(reversed(entries))
+
+    def _write(self, entries: Iterable) -> None:
+        for entry in entries:
+            cell_id = entry.id or ""
+            try:
+                with self._db:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO cells VALUES (?, ?, ?, ?, ?, ?)",
+                        (
+                            cell_id,
+                            entry.source_hash,
+                            entry.result.info.raw_cell,
+                            entry.result.execution_count,
+                            self._dump_result(entry),
+                            pickle.dumps(entry.facts),
+                        ),
+                    )
+                    self._db.executemany(
+                        "INSERT OR REPLACE INTO tags VALUES (?, ?, ?)",
+                        (
+                            (tag, cell_id, entry.source_hash)
+                            for tag in entry.tags
+                        ),
+                    )
+            except (sqlite3.Error, pickle.PicklingError, SyntaxError) as e:
+                warnings.warn(f"Tag {entry.tags} wasn't saved: {e}")
+        with self._db:
+            # Forget cells that no longer have a tag.
+            self._db.execute(
+                """DELETE FROM cells WHERE NOT EXISTS (
+                    SELECT 1 FROM tags
+                    WHERE tags.cell_id = cells.cell_id
+                    AND tags.source_hash = cells.source_hash)"""
+            )
+
+    def load(self, shell: InteractiveShell) -> Iterator[tuple[str, object]]:
+        """
+        Yield (tag, entry) tuples for the saved cells. Cells with more than
+        one tag are loaded once and shared by their tags.
+        """
+        from .tagcache import TagCacheEntry
+
+        entries = {}
+        rows = self._db.execute(
+            """SELECT tag, cells.cell_id, cells.source_hash, raw_cell,
+                execution_count, result, facts
+            FROM tags JOIN cells USING (cell_id, source_hash)
+            ORDER BY tag"""
+        )
+        for tag, cell_id, source_hash, raw_cell, count, result, facts in rows:
+            key = (cell_id, source_hash)
+            if key not in entries:
+                info = ExecutionInfo(
+                    raw_cell, True, False, True, cell_id or None
+                )
+                exec_result = ExecutionResult(info)
+                exec_result.execution_count = count
+                exec_result.result = _loads(result)
+                entries[key] = TagCacheEntry(
+                    exec_result, shell, facts=_loads(facts)
+                )
+            yield tag, entries[key]
+
+    def close(self) -> None:
+        """Write the queued entries and close the database."""
+        atexit.unregister(self.close)
+        try:
+            self.flush()
+        finally:
+            self._db.close()
+
+    def _dump_result(self, entry) -> Union[bytes, None]:
+        if entry.result_released or entry.result_size > self.max_result_bytes:
+            return None
+        try:
+            return pickle.dumps(entry.result.result)
+        except Exception:
+            # Lots of things can't be pickled.
+            return None
+
+
+def _loads(data: Union[bytes, None]) -> object:
+    if data is None:
+        return None
+    try:
+        return pickle.loads(data)
+    except Exception:
+        # The class of a pickled value may not be defined yet.
+        return None
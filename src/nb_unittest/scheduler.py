@@ -0,0 +1,90 @@
+"""
+Scheduling of asynchronous test runs.
+"""
+
+import asyncio
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Awaitable, Callable, Union
+
+if TYPE_CHECKING:
+    from .unit import NotebookResult
+
+
+@dataclass
+class TestRun:
+    """
+    The state of one asynchronous run of a %%testing cell.
+
+    key: The cell the run belongs to.
+    result: The result of the tests, once they've finished.
+    error: The reason the run failed, or `None` if it succeeded.
+    """
+
+    key: str
+    result: Union["NotebookResult", None] = None
+    error: Union[BaseException, None] = None
+    task: Union[asyncio.Task, None] = field(default=None, repr=False)
+
+    @property
+    def done(self) -> bool:
+        return self.task is not None and self.task.done()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.task is not None and self.task.cancelled()
+
+
+class TestScheduler:
+    """
+    Runs asynchronous tests in tasks. A cell has at most one run in flight:
+    running a cell again cancels the run it started before. At most
+    `max_runs` runs execute at the same time, the others wait their turn.
+    """
+
+    def __init__(self, max_runs: Union[int, None] = None):
+        self.max_runs = max_runs
+        self.runs = {}
+        self._semaphore = None
+
+    def submit(
+        self, key: str, function: Callable[[TestRun], Awaitable[None]]
+    ) -> TestRun:
+        """
+        Start a run of the cell `key` in a new task that awaits
+        `function(run)`. A run of the same cell that hasn't finished is
+        cancelled.
+        """
+        self.cancel(key)
+        if self._semaphore is None and self.max_runs is not None:
+            self._semaphore = asyncio.Semaphore(self.max_runs)
+
+        run = TestRun(key)
+
+        async def start():
+            if self._semaphore is None:
+                return await function(run)
+            async with self._semaphore:
+                return await function(run)
+
+        def finished(task):
+            if self.runs.get(key) is run:
+                del self.runs[key]
+
+        run.task = asyncio.create_task(start(), name=f"Test Runner {key}")
+        run.task.add_done_callback(finished)
+        self.runs[key] = run
+        return run
+
+    def cancel(self, key: Union[str, None] = None) -> None:
+        """Cancel the run of a cell, or every run if `key` is `None`."""
+        keys = list(self.runs) if key is None else [key]
+        for key in keys:
+            run = self.runs.pop(key, None)
+            if run is not None:
+                run.task.cancel()
+
+    async def wait(self) -> None:
+        """Wait for the runs in flight to finish."""
+        tasks = [run.task for run in self.runs.values()]
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,343 @@
+"""
+Detection of similar code across submissions.
+
+Every function and class is reduced to a fingerprint. The parse tree is turned
+into a stream of node types, with names and values left out so that renaming
+variables doesn't hide a copy. Hashes of overlapping runs of k tokens
+(shingles) are winnowed to a smaller set that still finds every long enough
+match, and the set is summarized by a MinHash signature. Signatures are split
+into bands and hashed into buckets, so only definitions that share a bucket are
+compared (locality sensitive hashing) instead of every pair.
+"""
+
+import array
+import ast
+import hashlib
+import itertools
+import random
+import sqlite3
+from collections import defaultdict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Iterator, Union
+
+from .analysis import AnalysisNode
+
+# A Mersenne prime for the MinHash permutations.
+_prime = (1 << 61) - 1
+
+_schema = """
+CREATE TABLE IF NOT EXISTS fingerprints (
+    submission TEXT NOT NULL,
+    name TEXT NOT NULL,
+    signature BLOB NOT NULL,
+    hashes BLOB NOT NULL,
+    PRIMARY KEY (submission, name)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+@dataclass(frozen=True)
+class Fingerprint:
+    """
+    The fingerprint of a function or class in a submission.
+
+    name: "def <name>" for functions and "class <name>" for classes.
+    signature: The MinHash signature of the winnowed hashes.
+    hashes: The winnowed hashes, used to check candidate matches.
+    """
+
+    submission: str
+    name: str
+    signature: tuple[int, ...]
+    hashes: frozenset[int]
+
+    @property
+    def key(self) -> tuple[str, str]:
+        return (self.submission, self.name)
+
+    def similarity(self, other: "Fingerprint") -> float:
+        """The Jaccard similarity of the winnowed hashes."""
+        if not self.hashes or not other.hashes:
+            return 0.0
+        shared = len(self.hashes & other.hashes)
+        return shared / (len(self.hashes) + len(other.hashes) - shared)
+
+
+@dataclass(frozen=True)
+class Match:
+    """Two definitions from different submissions that look alike."""
+
+    first: tuple[str, str]
+    second: tuple[str, str]
+    similarity: float
+
+
+class SimilarityIndex:
+    """
+    An index of fingerprints from many submissions.
+
+    path: An SQLite database that keeps the fingerprints. Fingerprints saved
+        there before are loaded, so new submissions can be added later
+        without fingerprinting the old ones again. A database made with a
+        different k, window, bands or rows raises a ValueError.
+    k: The number of tokens in a shingle.
+    window: The number of shingles that winnowing picks one hash from.
+    bands, rows: The shape of the LSH index. Signatures have bands * rows
+        values. More rows per band make a candidate pair more similar.
+    min_tokens: Definitions with fewer tokens are too small to compare.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path, None] = None,
+        k: int = 5,
+        window: int = 4,
+        bands: int = 16,
+        rows: int = 4,
+        min_tokens: int = 20,
+    ):
+        self.k = k
+        self.window = window
+        self.bands = bands
+        self.rows = rows
+        self.min_tokens = min_tokens
+        rng = random.Random(0)
+        self._permutations = [
+            (rng.randrange(1, _prime), rng.randrange(0, _prime))
+            for _ in range(bands * rows)
+        ]
+        self.fingerprints = {}
+        self._buckets = defaultdict(set)
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path)
+            self._db.executescript(_schema)
+            try:
+                self._check_parameters()
+            except ValueError:
+                self.close()
+                raise
+            for row in self._db.execute("SELECT * FROM fingerprints"):
+                self._insert(_from_row(*row))
+
+    def add(self, submission: str, node: AnalysisNode) -> list[Fingerprint]:
+        """
+        Fingerprint the top level functions and classes of `node` and add
+        them to the index. The definitions that were added for `submission`
+        before are replaced.
+        """
+        self.remove(submission)
+        return self.update(submission, [node])
+
+    def add_notebook(
+        self, path: Union[str, Path], submission: Union[str, None] = None
+    ) -> list[Fingerprint]:
+        """
+        Add the definitions in a notebook file without running it. Cells that
+        don't parse have no definitions. The submission is named after the
+        path.
+        """
+        from .static import load_notebook
+
+        submission = str(path) if submission is None else submission
+        self.remove(submission)
+        return self.update(submission, load_notebook(path).cells)
+
+    def update(
+        self, submission: str, nodes: Iterable[AnalysisNode]
+    ) -> list[Fingerprint]:
+        """Add definitions, replacing the ones that have the same name."""
+        added = []
+        for node in nodes:
+            children = [
+                *(("def", n, c) for n, c in node.functions.items()),
+                *(("class", n, c) for n, c in node.classes.items()),
+            ]
+            for kind, name, child in children:
+                fp = self.fingerprint(submission, f"{kind} {name}", child)
+                if fp is not None:
+                    self._remove(fp.key)
+                    self._insert(fp)
+                    added.append(fp)
+        if self._db is not None:
+            with self._db:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?)",
+                    (_to_row(fp) for fp in added),
+                )
+        return added
+
+    def remove(self, submission: str) -> None:
+        """Remove a submission from the index."""
+        for key in [k for k in self.fingerprints if k[0] == submission]:
+            self._remove(key)
+        if self._db is not None:
+            with self._db:
+                self._db.execute(
+                    "DELETE FROM fingerprints WHERE submission = ?",
+                    (submission,),
+                )
+
+    def fingerprint(
+        self, submission: str, name: str, node: AnalysisNode
+    ) -> Union[Fingerprint, None]:
+        """
+        Fingerprint a definition. Returns `None` if it's too small to
+        compare.
+        """
+        stream = list(tokens(node._node))
+        if len(stream) < max(self.min_tokens, self.k):
+            return None
+        hashes = winnow(shingles(stream, self.k), self.window)
+        return Fingerprint(submission, name, self.minhash(hashes), hashes)
+
+    def minhash(self, hashes: Iterable[int]) -> tuple[int, ...]:
+        """The MinHash signature of a set of hashes."""
+        hashes = list(hashes)
+        if not hashes:
+            return tuple(_prime for _ in self._permutations)
+        return tuple(
+            min((a * h + b) % _prime for h in hashes)
+            for a, b in self._permutations
+        )
+
+    def candidates(self) -> Iterator[tuple[Fingerprint, Fingerprint]]:
+        """
+        Yield each pair of definitions from different submissions that share
+        an LSH bucket, once.
+        """
+        seen = set()
+        for bucket in self._buckets.values():
+            if len(bucket) < 2:
+                continue
+            for a, b in itertools.combinations(sorted(bucket), 2):
+                if a[0] != b[0] and (a, b) not in seen:
+                    seen.add((a, b))
+                    yield self.fingerprints[a], self.fingerprints[b]
+
+    def similar(self, threshold: float = 0.5) -> list[Match]:
+        """
+        Return the pairs of definitions from different submissions with a
+        similarity of at least `threshold`, most similar first.
+        """
+        matches = []
+        for a, b in self.candidates():
+            similarity = a.similarity(b)
+            if similarity >= threshold:
+                matches.append(Match(a.key, b.key, similarity))
+        matches.sort(key=lambda m: (-m.similarity, m.first, m.second))
+        return matches
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _check_parameters(self) -> None:
+        # Signatures and hashes are only comparable with the same parameters.
+        parameters = {
+            "k": self.k,
+            "window": self.window,
+            "bands": self.bands,
+            "rows": self.rows,
+        }
+        saved = dict(self._db.execute("SELECT name, value FROM meta"))
+        if not saved:
+            (count,) = self._db.execute(
+                "SELECT COUNT(*) FROM fingerprints"
+            ).fetchone()
+            if count:
+                raise ValueError(
+                    "The database has fingerprints without their parameters."
+                )
+            with self._db:
+                self._db.executemany(
+                    "INSERT INTO meta VALUES (?, ?)", parameters.items()
+                )
+        elif saved != parameters:
+            raise ValueError(
+                f"The database was made with {saved}, not {parameters}."
+            )
+
+    def _insert(self, fp: Fingerprint) -> None:
+        self.fingerprints[fp.key] = fp
+        for band in self._bands(fp):
+            self._buckets[band].add(fp.key)
+
+    def _remove(self, key: tuple[str, str]) -> None:
+        fp = self.fingerprints.pop(key, None)
+        if fp is None:
+            return
+        for band in self._bands(fp):
+            self._buckets[band].discard(key)
+            if not self._buckets[band]:
+                del self._buckets[band]
+
+    def _bands(self, fp: Fingerprint) -> Iterator[tuple]:
+        for i in range(self.bands):
+            yield (i, *fp.signature[i * self.rows : (i + 1) * self.rows])
+
+
+def tokens(tree: ast.AST) -> Iterator[str]:
+    """
+    Yield the node types of a tree in source order. Names, attributes and
+    constants are replaced by their kind so that renaming doesn't matter.
+    """
+    todo = [tree]
+    while todo:
+        node = todo.pop()
+        if isinstance(node, ast.Constant):
+            yield f"Constant:{type(node.value).__name__}"
+        elif not isinstance(node, ast.expr_context):
+            yield node.__class__.__name__
+        todo.extend(reversed(list(ast.iter_child_nodes(node))))
+
+
+def shingles(stream: list[str], k: int) -> list[int]:
+    """Hash each run of `k` tokens. The hashes don't change between runs."""
+    return [
+        int.from_bytes(
+            hashlib.blake2b(
+                " ".join(stream[i : i + k]).encode(), digest_size=8
+            ).digest(),
+            "big",
+        )
+        for i in range(len(stream) - k + 1)
+    ]
+
+
+def winnow(hashes: list[int], window: int) -> frozenset[int]:
+    """
+    Pick the smallest hash from each window of `window` hashes. Any run of
+    tokens that covers a whole window is found in both copies.
+    """
+    if len(hashes) <= window:
+        return frozenset([min(hashes)] if hashes else [])
+    return frozenset(
+        min(hashes[i : i + window]) for i in range(len(hashes) - window + 1)
+    )
+
+
+def _to_row(fp: Fingerprint) -> tuple:
+    return (
+        fp.submission,
+        fp.name,
+        array.array("Q", fp.signature).tobytes(),
+        array.array("Q", sorted(fp.hashes)).tobytes(),
+    )
+
+
+def _from_row(
+    submission: str, name: str, signature: bytes, hashes: bytes
+) -> Fingerprint:
+    return Fingerprint(
+        submission,
+        name,
+        tuple(array.array("Q", signature)),
+        frozenset(array.array("Q", hashes)),
+    )
@@ -0,0 +1,213 @@
+"""
+Analysis of notebook cells without running them.
+
+Notebooks are read directly from .ipynb files. Cells are transformed the way
+IPython transforms them before they run, so magics become function calls, and
+tags are found in cell docstrings the same way the tag cache finds them.
+"""
+
+import ast
+import hashlib
+import io
+import json
+import re
+import tokenize
+import weakref
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Callable, Iterator, Set, Union
+
+from .analysis import AnalysisNode, Facts
+
+# Parsed cells shared by entries with the same source, keyed by source hash.
+_parses = weakref.WeakValueDictionary()
+
+_transformer = None
+
+
+class CellNode(AnalysisNode):
+    """
+    The analysis of a notebook cell. The cell is transformed and parsed on
+    first use and the parse is shared with other cells that have the same
+    source. A cell that doesn't parse is analyzed as an empty cell.
+    """
+
+    def __init__(
+        self,
+        raw_cell: str,
+        cell_id: Union[str, None] = None,
+        transform: Union[Callable[[str], str], None] = None,
+        facts: Union[Facts, None] = None,
+    ):
+        """
+        Create a node for a cell. Tags are found by scanning the docstring of
+        the raw cell.
+
+        transform: A function that turns a raw cell into Python, like
+            `shell.transform_cell`. The default uses IPython's transformer
+            without a shell.
+        facts: Facts that were saved earlier, used instead of parsing.
+        """
+
+        # AnalysisNode.__init__() isn't called, the source and tree are lazy.
+        self._id = cell_id
+        self._raw_cell = raw_cell
+        self._transform = transform or _transform_cell
+        self._hash = hashlib.sha256(raw_cell.encode()).hexdigest()
+        self._facts = facts
+        self._analysis = None
+        self._functions = None
+        self._classes = None
+        self._lines = None
+        self._index = None
+        self._tags = find_tags(raw_cell)
+
+    @property
+    def _source(self) -> str:
+        return self._get_analysis()._source
+
+    @property
+    def _tree(self) -> ast.AST:
+        return self._get_analysis()._tree
+
+    @property
+    def facts(self) -> Facts:
+        if self._facts is None:
+            self._facts = self._get_analysis().facts
+        return self._facts
+
+    def _get_analysis(self) -> AnalysisNode:
+        if self._analysis is None:
+            self._analysis = _parses.get(self._hash)
+            if self._analysis is None:
+                source = self._transform(self._raw_cell)
+                try:
+                    self._analysis = AnalysisNode(source)
+                except SyntaxError:
+                    # The cell has no definitions, like a cell that's empty.
+                    self._analysis = AnalysisNode(source, ast.Module([], []))
+                _parses[self._hash] = self._analysis
+        return self._analysis
+
+    @property
+    def id(self) -> str:
+        """The unique identifier of the notebook cell."""
+        return self._id
+
+    @property
+    def source_hash(self) -> str:
+        """A SHA-256 hash of the cell's raw source."""
+        return self._hash
+
+    @property
+    def tags(self) -> Set[str]:
+        """A set of the tags found in the cell."""
+        return set(self._tags)
+
+
+class NotebookCache(Mapping):
+    """
+    An analysis-only tag cache for a notebook file. It maps tags to the last
+    code cell in the notebook with the tag, like a tag cache would after
+    running the notebook from top to bottom. Nothing is run, so the cells
+    have no results.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self.cells = [
+            CellNode(source, cell_id) for cell_id, source in read_cells(path)
+        ]
+        self._tags = {}
+        for cell in self.cells:
+            for tag in cell._tags:
+                self._tags[tag] = cell
+
+    def __getitem__(self, tag: str) -> CellNode:
+        return self._tags[tag]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._tags)
+
+    def __len__(self) -> int:
+        return len(self._tags)
+
+
+def load_notebook(path: Union[str, Path]) -> NotebookCache:
+    """Read a notebook file and return an analysis-only tag cache."""
+    return NotebookCache(path)
+
+
+def read_cells(path: Union[str, Path]) -> list[tuple[str, str]]:
+    """
+    Read a notebook file and return a list of (cell id, source) tuples for
+    each code cell. The cell id is `None` for older notebook formats.
+    """
+    with open(path, encoding="utf-8") as fh:
+        nb = json.load(fh)
+
+    cells = []
+    for cell in nb.get("cells", []):
+        if cell.get("cell_type") == "code":
+            source = cell.get("source", "")
+            if isinstance(source, list):
+                source = "".join(source)
+            cells.append((cell.get("id"), source))
+    return cells
+
+
+def find_tags(cell: str) -> list[str]:
+    """Return the tags in the docstring of a cell, in order."""
+    if "@" not in cell:
+        return []
+    docstring = _find_docstring(cell)
+    if docstring is None:
+        return []
+    return [
+        m.group(1)
+        for x in docstring.split()
+        if (m := re.match(r"(@\S+)", x)) is not None
+    ]
+
+
+def _find_docstring(cell: str) -> Union[str, None]:
+    """
+    Find the docstring of a cell without parsing it. The docstring is the
+    value of a first statement that only contains string literals.
+    """
+    strings = []
+    try:
+        for token in tokenize.generate_tokens(io.StringIO(cell).readline):
+            if token.type in (
+                tokenize.COMMENT,
+                tokenize.NL,
+                tokenize.INDENT,
+                tokenize.DEDENT,
+            ):
+                continue
+            elif token.type == tokenize.STRING:
+                strings.append(token.string)
+            elif strings and (
+                token.type in (tokenize.NEWLINE, tokenize.ENDMARKER)
+                or token.string == ";"
+            ):
+                break
+            else:
+                return None
+        docstring = ast.literal_eval(" ".join(strings))
+    except (tokenize.TokenError, SyntaxError, ValueError):
+        return None
+
+    if isinstance(docstring, str):
+        return docstring
+    return None
+
+
+def _transform_cell(cell: str) -> str:
+    # The same transforms IPython applies to cells, without a shell.
+    global _transformer
+    if _transformer is None:
+        from IPython.core.inputtransformer2 import TransformerManager
+
+        _transformer = TransformerManager()
+    return _transformer.transform_cell(cell)
@@ -4,31 +4,70 @@ The implementation of a cell tag cache.
 
 import ast
 import asyncio
-import io
+import contextlib
+import copy
+import hashlib
+import os
 import re
 import sys
 import types
 import unittest
+import weakref
 from dataclasses import dataclass
-from typing import Any, Mapping, Set, Union
-
-import IPython.core.ultratb
-import ipywidgets
-from IPython.core.interactiveshell import ExecutionResult, InteractiveShell
-from IPython.core.magic import Magics, cell_magic, magics_class
-from IPython.display import HTML
-
-from .analysis import AnalysisNode
+from typing import Any, Iterable, Mapping, TextIO, Union
+
+from IPython.core.interactiveshell import (
+    ExecutionInfo,
+    ExecutionResult,
+    InteractiveShell,
+)
+from IPython.core.magic import Magics, cell_magic, line_magic, magics_class
+from IPython.display import HTML, display
+
+from .analysis import Facts
+from .capture import CappedOutput, CaptureLimits
+from .codecache import code_cache
+from .cpu import CPUProfile, CPUProfiler
+from .depgraph import DependencyGraph, TestCell
+from .memo import ResultMemo, memo_key
+from .memory import MemoryProfile, MemoryProfiler
+from .persist import TagDatabase
+from .scheduler import TestScheduler
+from .static import CellNode
+from .tagstore import TagStore, sizeof
 from .templ import templ
 from .transforms import RewriteVariableAssignments
-from .unit import AsyncFunctionTestCase, NotebookTestRunner, NotebookTestSuite
 
 nbtest_attrs = {}
-runner_class = NotebookTestRunner
+# runner_class is the test runner, NotebookTestRunner unless it's set.
+show_timings = False
+profile_tests = False
+stream_results = False
+result_budget = 256 * 2**20
+history_size = 5
+capture_limits = CaptureLimits()
+max_async_runs = 4
+auto_retest = False
+result_memo: Union[ResultMemo, None] = None
+persist_path = os.environ.get("NB_UNITTEST_CACHE")
 _last_succeeded = None
 _last_error = None
 
 
+def __getattr__(name: str) -> Any:
+    # The test machinery is imported when it's first used.
+    if name == "runner_class":
+        from .unit import NotebookTestRunner
+
+        return NotebookTestRunner
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _runner_class() -> Any:
+    """The test runner class that %%testing cells use."""
+    return globals().get("runner_class") or __getattr__("runner_class")
+
+
 def assert_error():
     """
     Return an exception if the last test run failed or None if it succeeded,
@@ -51,12 +90,25 @@ def assert_ok():
 
 @dataclass
 class CellRunResult:
-    """The result of calling run() on a TagCacheEntry"""
+    """
+    The result of calling run() on a TagCacheEntry. The `_truncated` flags
+    are set when output went over the capture limits. With spilling turned
+    on, the `_file` attributes are temporary files with all of the output.
+    `memory` and `cpu` are the memory and CPU profiles of the run if they
+    were asked for.
+    """
 
     stdout: str
     stderr: str
     outputs: list[Any]
     result: Any
+    stdout_truncated: bool = False
+    stderr_truncated: bool = False
+    outputs_truncated: bool = False
+    stdout_file: Union[TextIO, None] = None
+    stderr_file: Union[TextIO, None] = None
+    memory: Union[MemoryProfile, None] = None
+    cpu: Union[CPUProfile, None] = None
 
 
 @magics_class
@@ -69,8 +121,31 @@ class TagCache(Magics):
     def __init__(self, shell: InteractiveShell):
         """Initialize the plugin."""
         super().__init__(shell)
-        self._cache = {}
+        self._cache = TagStore(result_budget, history_size)
         self._test_ns = {"shell": self.shell}
+        self.last_result = None
+        self.last_run = None
+        self.scheduler = TestScheduler(max_async_runs)
+        self.database = None
+        self.graph = DependencyGraph()
+        self._cell_key = None
+        self._retesting = False
+
+    def persist(self, path: str) -> None:
+        """
+        Save tagged cells in a database at `path` and load the cells that
+        were saved there before. Loaded cells don't replace cells that have
+        already run. Cells are written when they're evicted and when the
+        database is closed.
+        """
+        if self.database is not None:
+            self.database.close()
+        self.database = TagDatabase(path)
+        # Evicted values are gone, so their cells are saved first.
+        self._cache.on_evict = self.database.flush
+        for tag, entry in self.database.load(self.shell):
+            if tag not in self._cache:
+                self._cache[tag] = entry
 
     @cell_magic
     def testing(self, line: str, cell: str) -> HTML:
@@ -79,11 +154,35 @@ class TagCache(Magics):
         """
         global nbtest_attrs, _last_error, _last_succeeded
 
+        from .unit import (
+            AsyncFunctionTestCase,
+            NotebookResult,
+            NotebookTestSuite,
+            StreamingResult,
+        )
+
         _last_succeeded = False
         _last_error = None
+        self.last_result = None
+        self.last_run = None
 
         self._test_ns["nbtest_cases"] = None
         nbtest_attrs.clear()
+        key = self._cell_key or hashlib.sha256(cell.encode()).hexdigest()
+        magic_line = line
+
+        # Options like --timeout=2 configure the test runner.
+        settings = _parse_options(re.findall(r"--([\w-]+)=([^\s,]+)", line))
+        line = re.sub(r"\s*--[\w-]+=[^\s,]+\s*,?", " ", line)
+        line = line.strip().rstrip(",")
+
+        names = [s.split()[0] for s in line.split(",") if s.strip()]
+        if self._retesting:
+            test = TestCell(key, magic_line, cell, frozenset(names))
+        else:
+            # Remember what the cell tests so it can run again when the
+            # cells it depends on change.
+            test = self.graph.add_test(key, magic_line, cell, names)
 
         # Find extended symbols mentioned in the cell magic
         if line.strip() != "":
@@ -122,14 +221,34 @@ class TagCache(Magics):
 
         # Run the cell
         try:
-            tree = ast.parse(cell)
-            exec(
-                compile(tree, filename="<testing>", mode="exec"), self._test_ns
+            tree, code = code_cache.get(
+                ("testing", hashlib.sha256(cell.encode()).hexdigest()),
+                lambda: _compile_testing(cell),
             )
+            exec(code, self._test_ns)
         except AssertionError as e:
             _last_error = e
             return HTML(templ.assertion.render(error=e))
 
+        # Show the saved result if nothing the cell depends on changed. The
+        # cell still runs so that it defines its names for the cells after it.
+        memo = result_memo
+        memo_id = None
+        if memo is not None:
+            memo_id = memo_key(
+                test, self.graph, self.shell.user_ns, _runner_class()
+            )
+            cached = memo.get(memo_id) if memo_id else None
+            if cached is not None:
+                self.last_result = cached
+                if not cached.wasSuccessful():
+                    _last_error = RuntimeError("A test failed.")
+                return HTML(
+                    templ.result.render(
+                        result=cached, show_timings=show_timings
+                    )
+                )
+
         # Look for async test cases.
         do_async = False
         funct_testcase = unittest.FunctionTestCase
@@ -203,101 +322,266 @@ class TagCache(Magics):
 
         if do_async:
             # Asynchronous execution. This has some problems.
+            # Widgets are only needed here, they're slow to import.
+            import IPython.core.ultratb
+            import ipywidgets
 
             output = ipywidgets.Output()
             html = ipywidgets.HTML(templ.wait.render())
             output.append_display_data(html)
 
-            async def do_run():
+            async def do_run(run):
                 global _last_error
                 nonlocal output
+                cancelled = None
                 try:
                     with output:
-                        runner = runner_class()
-                        result = await runner.async_run(suite)
-                        html.value = templ.result.render(result=result)
-                        if result.wasSuccessful():
-                            _last_error = None
+                        runner = _make_runner(settings)
+                        profiler = self._profiler()
+                        try:
+                            with profiler or contextlib.nullcontext():
+                                run.result = await runner.async_run(suite)
+                        except asyncio.CancelledError as e:
+                            # The output widget would swallow it.
+                            cancelled = e
                         else:
-                            _last_error = RuntimeError("An aync test failed.")
+                            if profiler is not None:
+                                run.result.profile = profiler.profile
+                            if memo_id and not run.result.exceeded:
+                                memo.put(memo_id, run.result)
+                            html.value = templ.result.render(
+                                result=run.result, show_timings=show_timings
+                            )
+                            if not run.result.wasSuccessful():
+                                run.error = RuntimeError(
+                                    "An aync test failed."
+                                )
 
                 except Exception as e:
-                    _last_error = e
+                    run.error = e
                     formatter = IPython.core.ultratb.AutoFormattedTB(
                         mode="Verbose", color_scheme="Linux"
                     )
                     output.append_stderr(formatter.text(*sys.exc_info()))
 
-            asyncio.create_task(do_run(), name="Test Runner")
+                if cancelled is not None:
+                    raise cancelled
+
+                if run is self.last_run:
+                    # Older runs that finish late don't replace the outcome
+                    # of a newer cell.
+                    self.last_result = run.result
+                    _last_error = run.error
+
+            def finished(task):
+                if task.cancelled():
+                    html.value = templ.cancelled.render()
+
+            self.last_run = self.scheduler.submit(key, do_run)
+            self.last_run.task.add_done_callback(finished)
             return output
 
         else:
             # Synchronous execution.
-            runner = runner_class()
-            result = runner.run(suite)
+            runner = _make_runner(settings)
+            profiler = self._profiler()
+            with profiler or contextlib.nullcontext():
+                if stream_results:
+                    # Show the tests as they finish in a display that's
+                    # replaced by the report.
+                    total = suite.countTestCases()
+
+                    def progress(result):
+                        return HTML(
+                            templ.progress.render(result=result, total=total)
+                        )
+
+                    handle = display(
+                        progress(NotebookResult()), display_id=True
+                    )
+                    result = runner.run(
+                        suite,
+                        StreamingResult(
+                            lambda result: handle.update(progress(result))
+                        ),
+                    )
+                else:
+                    result = runner.run(suite)
+            if profiler is not None:
+                result.profile = profiler.profile
+            if memo_id and not result.exceeded:
+                # Runs that went over a limit might not next time.
+                memo.put(memo_id, result)
+            self.last_result = result
             if result.wasSuccessful():
                 _last_error = None
             else:
                 _last_error = RuntimeError("A test failed.")
-            return HTML(templ.result.render(result=result))
+            html = HTML(
+                templ.result.render(result=result, show_timings=show_timings)
+            )
+            if stream_results:
+                handle.update(html)
+                return None
+            return html
+
+    def _profiler(self) -> Union[CPUProfiler, None]:
+        """A profiler for the tagged cells if tests are profiled."""
+        if not profile_tests:
+            return None
+        return CPUProfiler(
+            {tag: entry.source for tag, entry in self._cache.items()}
+        )
+
+    @line_magic
+    def retest(self, line: str) -> None:
+        """
+        Run the %%testing cells that are out of date because a cell they
+        depend on ran again. With tags or symbols, run the testing cells that
+        depend on them instead.
+        """
+        names = [s for s in re.split(r"[\s,]+", line) if s]
+        tests = self.graph.stale(names or None)
+        if not tests:
+            print("All tests are up to date.")
+        self.run_tests(tests)
+
+    def run_tests(self, tests: list[TestCell]) -> None:
+        """
+        Run %%testing cells again and display their reports in the current
+        cell.
+        """
+        saved_key = self._cell_key
+        self._retesting = True
+        try:
+            for test in tests:
+                self._cell_key = test.key
+                test.stale = False
+                output = self.testing(test.line, test.source)
+                if output is not None:
+                    display(output)
+        finally:
+            self._cell_key = saved_key
+            self._retesting = False
+
+    def pre_run_cell(self, info):
+        """
+        Callback before a cell runs. Remembers the cell so that a new run of
+        its async tests replaces the old one.
+        """
+        self._cell_key = info.cell_id
 
     def post_run_cell(self, result):
         """
         Callback after a cell has run.
         """
-        if result.execution_count is not None:
-            # Avoid caching on run().
+        if (
+            result.execution_count is None
+            or result.error_before_exec is not None
+        ):
+            # Avoid caching on run() and cells that don't compile.
+            return
+        raw_cell = result.info.raw_cell
+        entry = None
+        if "@" in raw_cell:
+            # Only cells with an @ can have a tag.
             entry = TagCacheEntry(result, self.shell)
+            if self.database is not None and entry.tags:
+                # Queued first, so it's saved if caching it evicts its value.
+                self.database.save(entry)
             for tag in entry.tags:
                 self._cache[tag] = entry
+        if raw_cell.lstrip().startswith("%%testing"):
+            return
+        if entry is not None and entry.tags:
+            key = entry.id or ",".join(sorted(entry.tags))
+        else:
+            # Untagged cells are in the graph for the names they define, so
+            # tests of those names go out of date. They aren't cached, so
+            # their nodes don't keep their results. A cell without an id is
+            # known by its execution count, and the graph drops it once its
+            # names are defined again.
+            entry = CellNode(
+                raw_cell, result.info.cell_id, self.shell.transform_cell
+            )
+            key = entry.id or f"In[{result.execution_count}]"
+        affected = self.graph.add_cell(key, entry)
+        if auto_retest and affected and result.success:
+            self.run_tests(affected)
 
 
-class TagCacheEntry(AnalysisNode):
+class TagCacheEntry(CellNode):
     """
     Information about an executed cell.
     """
 
-    def __init__(self, result, shell):
-        """Create an entry."""
-
-        self._id = result.info.cell_id
+    def __init__(self, result, shell, facts: Union[Facts, None] = None):
+        """
+        Create an entry. The cell is transformed with the shell's transforms.
+        Entries that are loaded from disk can pass in their saved `facts`.
+        """
+        super().__init__(
+            result.info.raw_cell,
+            result.info.cell_id,
+            shell.transform_cell,
+            facts,
+        )
         self._result = result
         self._shell = shell
-        self._tags = []
-
-        try:
-            source = shell.transform_cell(result.info.raw_cell)
-            super().__init__(source)
-            if self.docstring is not None:
-                self._tags = [
-                    m.group(1)
-                    for x in self.docstring.split()
-                    if (m := re.match(r"(@\S+)", x)) is not None
-                ]
-        except SyntaxError:
-            super().__init__(None, None)
-
-    @property
-    def id(self) -> str:
-        """The unique identifier of the notebook cell."""
-        return self._id
+        self._result_ref = None
+        self._result_size = None
 
     @property
     def result(self) -> ExecutionResult:
-        """The ExecutionResult from running the cell in IPython."""
+        """
+        The ExecutionResult from running the cell in IPython. If the result's
+        value was released it's `None` unless something else still holds it.
+        """
+        if self._result_ref is not None:
+            result = copy.copy(self._result)
+            result.result = self._result_ref()
+            return result
         return self._result
 
     @property
-    def tags(self) -> Set[str]:
-        """A set of the tags found in the cell."""
-        return set(self._tags)
+    def result_size(self) -> int:
+        """An estimate of the number of bytes used by the result's value."""
+        if self._result_size is None:
+            self._result_size = sizeof(self._result.result)
+        return self._result_size
+
+    @property
+    def result_released(self) -> bool:
+        """True if the cache no longer holds the result's value."""
+        return self._result.result is None
+
+    def release_result(self) -> None:
+        """
+        Drop the entry's reference to the result's value. A weak reference is
+        kept if the value supports it.
+        """
+        value = self._result.result
+        if value is None:
+            return
+        try:
+            self._result_ref = weakref.ref(value)
+        except TypeError:
+            self._result_ref = None
+        # The ExecutionResult is shared with IPython, change a copy.
+        self._result = copy.copy(self._result)
+        self._result.result = None
 
     @property
     def ns(self) -> Mapping:
         return self._shell.user_ns
 
     def run(
-        self, push: Mapping = {}, capture: bool = True
+        self,
+        push: Mapping = {},
+        capture: bool = True,
+        limits: Union[CaptureLimits, None] = None,
+        profile_memory: bool = False,
+        profile_cpu: bool = False,
     ) -> Union[CellRunResult, None]:
         """
         Run the contents of a cached cell.
@@ -306,56 +590,281 @@ class TagCacheEntry(AnalysisNode):
             in `push` before running the contents.
         capture: Set to `True` (the default) to capture stdout, stderr and
             output. If `False` run() returns `None`
+        limits: How much output to capture. The default is
+            `tagcache.capture_limits`.
+        profile_memory: Set to `True` to measure the memory allocated by the
+            cell with tracemalloc. The profile is in the result's `memory`.
+        profile_cpu: Set to `True` to find the lines of the cell that take
+            the most time. The profile is in the result's `cpu`.
         """
-        self._shell.push(push)
-        try:
-            save_out = sys.stdout
-            save_err = sys.stderr
-            save_idh = sys.displayhook
-            save_edh = self._shell.user_ns["__builtins__"].display
-
-            out = io.StringIO()
-            err = io.StringIO()
-            outputs = []
-            result = None
-
-            def explicit_displayhook(obj):
-                nonlocal outputs
-                if obj is not None:
+        results = self.run_many(
+            [push],
+            capture=capture,
+            limits=limits,
+            profile_memory=profile_memory,
+            profile_cpu=profile_cpu,
+        )
+        if capture:
+            return results[0]
+        else:
+            return None
+
+    def run_many(
+        self,
+        pushes: Iterable[Mapping],
+        capture: bool = True,
+        limits: Union[CaptureLimits, None] = None,
+        profile_memory: bool = False,
+        profile_cpu: bool = False,
+    ) -> Union[list[CellRunResult], None]:
+        """
+        Run the contents of a cached cell once for each mapping in `pushes`.
+        This is the same as calling run() in a loop but output capture, the
+        compiled cell and the shell's execution events are set up once for
+        the whole batch.
+
+        pushes: An iterable of mappings of names and values to push into the
+            notebook namespace before each run.
+        capture: Set to `True` (the default) to capture stdout, stderr and
+            output. If `False` run_many() returns `None`
+        limits: How much output to capture from each run. The default is
+            `tagcache.capture_limits`.
+        profile_memory: Set to `True` to profile the memory used by each
+            run. Profiling slows the cell down.
+        profile_cpu: Set to `True` to profile the time spent on each line
+            of the cell in each run.
+        """
+        limits = limits or capture_limits
+        shell = self._shell
+        builtins = shell.user_ns["__builtins__"]
+        save_out = sys.stdout
+        save_err = sys.stderr
+        save_idh = sys.displayhook
+        save_edh = builtins.display
+
+        results = []
+        outputs = []
+        outputs_truncated = False
+        result = None
+        compiled = {}
+
+        def explicit_displayhook(obj):
+            nonlocal outputs_truncated
+            if obj is not None:
+                if limits.outputs is None or len(outputs) < limits.outputs:
                     outputs.append(obj)
+                else:
+                    outputs_truncated = True
 
-            def implicit_displayhook(obj):
-                nonlocal result, explicit_displayhook
-                explicit_displayhook(obj)
-                result = obj
+        def implicit_displayhook(obj):
+            nonlocal result
+            explicit_displayhook(obj)
+            result = obj
 
+        info = ExecutionInfo(self.source, False, False, True, None)
+        exec_result = ExecutionResult(info)
+        shell.events.trigger("pre_execute")
+        shell.events.trigger("pre_run_cell", info)
+        try:
             if capture:
-                sys.stdout = out
-                sys.stderr = err
                 sys.displayhook = implicit_displayhook
-                self._shell.user_ns[
-                    "__builtins__"
-                ].display = explicit_displayhook
-
-            transformer = RewriteVariableAssignments(*list(push.keys()))
-            self._shell.ast_transformers.append(transformer)
-            self._shell.run_cell(
-                self.source, store_history=False, silent=False
-            )
-
-            if capture:
-                return CellRunResult(
-                    stdout=out.getvalue(),
-                    stderr=err.getvalue(),
-                    outputs=outputs,
-                    result=result,
-                )
-            else:
-                return None
+                builtins.display = explicit_displayhook
+
+            with shell.builtin_trap, shell.display_trap:
+                for push in pushes:
+                    shell.push(push)
+                    names = frozenset(push)
+                    if names not in compiled:
+                        compiled[names] = self._compile(names)
+
+                    out = CappedOutput(limits.stream, limits.spill)
+                    err = CappedOutput(limits.stream, limits.spill)
+                    outputs = []
+                    outputs_truncated = False
+                    result = None
+                    if capture:
+                        sys.stdout = out
+                        sys.stderr = err
+
+                    # Profilers by the name of their result attribute.
+                    profilers = {}
+                    if profile_memory and capture:
+                        profilers["memory"] = MemoryProfiler(
+                            self._filename(compiled[names])
+                        )
+                    if profile_cpu and capture:
+                        name = min(self.tags, default="cell")
+                        profilers["cpu"] = CPUProfiler({name: self.source})
+
+                    with contextlib.ExitStack() as stack:
+                        for profiler in profilers.values():
+                            stack.enter_context(profiler)
+                        if compiled[names] is not None:
+                            self._run_compiled(compiled[names], exec_result)
+                        else:
+                            transformer = RewriteVariableAssignments(*names)
+                            shell.ast_transformers.append(transformer)
+                            try:
+                                shell.run_cell(
+                                    self.source,
+                                    store_history=False,
+                                    silent=False,
+                                )
+                            finally:
+                                shell.ast_transformers.remove(transformer)
+
+                    sys.stdout = save_out
+                    sys.stderr = save_err
+                    if capture:
+                        results.append(
+                            CellRunResult(
+                                stdout=out.getvalue(),
+                                stderr=err.getvalue(),
+                                outputs=outputs,
+                                result=result,
+                                stdout_truncated=out.truncated,
+                                stderr_truncated=err.truncated,
+                                outputs_truncated=outputs_truncated,
+                                stdout_file=out.spilled(),
+                                stderr_file=err.spilled(),
+                                **{
+                                    name: profiler.profile
+                                    for name, profiler in profilers.items()
+                                },
+                            )
+                        )
 
         finally:
             sys.stdout = save_out
             sys.stderr = save_err
             sys.displayhook = save_idh
-            self._shell.user_ns["__builtins__"].display = save_edh
-            self._shell.ast_transformers.remove(transformer)
+            builtins.display = save_edh
+            shell.events.trigger("post_execute")
+            shell.events.trigger("post_run_cell", exec_result)
+
+        if capture:
+            return results
+        else:
+            return None
+
+    def _compile(self, names: Iterable[str]) -> Union[list, None]:
+        """
+        Compile the cell the way run_cell() would, with module level
+        assignments to `names` removed, and cache the code objects. Returns
+        `None` if the cell has to go through run_cell() instead, for example
+        when it uses top level await.
+        """
+        shell = self._shell
+        if shell.ast_node_interactivity != "last_expr":
+            return None
+
+        transformers = tuple(shell.ast_transformers)
+
+        def build():
+            transformer = RewriteVariableAssignments(*names)
+            shell.ast_transformers.append(transformer)
+            try:
+                tree = shell.transform_ast(ast.parse(self.source))
+                filename = shell.compile.cache(
+                    self.source, shell.execution_count, raw_code=self.source
+                )
+                nodes = tree.body
+                last = []
+                if nodes and isinstance(nodes[-1], ast.Expr):
+                    # The last expression is displayed.
+                    nodes, last = nodes[:-1], nodes[-1:]
+
+                # Statements before the last one run as a single module,
+                # which stops on the first error like run_cell() does.
+                codes = []
+                if nodes:
+                    codes.append(
+                        shell.compile(ast.Module(nodes, []), filename, "exec")
+                    )
+                if last:
+                    codes.append(
+                        shell.compile(
+                            ast.Interactive(last), filename, "single"
+                        )
+                    )
+                return codes
+            except Exception:
+                return None
+            finally:
+                shell.ast_transformers.remove(transformer)
+
+        return code_cache.get(
+            ("run", self._hash, frozenset(names), transformers), build
+        )
+
+    def _filename(self, codes: Union[list, None]) -> str:
+        """The file name the cell's code has when it runs."""
+        if codes:
+            return codes[0].co_filename
+        shell = self._shell
+        return shell.compile.get_code_name(
+            self.source,
+            shell.transform_cell(self.source),
+            shell.execution_count,
+        )
+
+    def _run_compiled(self, codes: list, result: ExecutionResult) -> None:
+        """Run the compiled cell the way run_cell() runs its code."""
+        for code in codes:
+            # run_code() never awaits unless it's asked to.
+            try:
+                self._shell.run_code(code, result).send(None)
+            except StopIteration as stop:
+                if stop.value:
+                    # An error was shown, skip the rest of the cell.
+                    break
+
+
+def _parse_options(options: list[tuple[str, str]]) -> dict[str, Any]:
+    """
+    Convert %%testing options into settings for the test runner. Limits that
+    start with "cell-" apply to the whole cell.
+    """
+    from .limits import Limits, parse_size
+
+    limits = {}
+    test_limits = {}
+    settings = {}
+    for option, value in options:
+        name = option.removeprefix("cell-")
+        target = limits if name != option else test_limits
+        if name in ("timeout", "cpu"):
+            target[name] = float(value)
+        elif name == "memory":
+            target[name] = parse_size(value)
+        elif option in ("concurrency", "threads"):
+            settings[option] = int(value)
+        else:
+            raise ValueError(f"""Unknown option "--{option}".""")
+    if limits:
+        settings["limits"] = Limits(**limits)
+    if test_limits:
+        settings["test_limits"] = Limits(**test_limits)
+    return settings
+
+
+def _make_runner(settings: dict[str, Any]):
+    """Create a test runner with the settings from %%testing options."""
+    from .limits import Limits
+
+    runner = _runner_class()()
+    for name, value in settings.items():
+        if not hasattr(runner, name):
+            # The runner class can be a partial, which has no name.
+            raise ValueError(
+                f"""{type(runner).__name__} doesn't support "{name}"."""
+            )
+        if isinstance(value, Limits):
+            value = getattr(runner, name).update(value)
+        setattr(runner, name, value)
+    return runner
+
+
+def _compile_testing(cell: str) -> tuple[ast.Module, types.CodeType]:
+    tree = ast.parse(cell)
+    return tree, compile(tree, filename="<testing>", mode="exec")
@@ -0,0 +1,144 @@
+"""
+A bounded store of tagged cells.
+"""
+
+import sys
+import types
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Any, Iterator
+
+# Containers with more objects than this are estimated from a sample.
+_max_objects = 10_000
+
+
+class TagStore(Mapping):
+    """
+    A mapping of tags to the most recent cells with those tags.
+
+    The values that tagged cells produce are kept until their total size goes
+    over `max_bytes`. Then the values of the least recently used cells are
+    released. Values that support weak references stay available while
+    something else, like IPython's output history, holds them.
+
+    The last `history_size` versions of each tag are kept. Only the current
+    version keeps its value.
+
+    `on_evict` is called with a current cell before its value is released to
+    stay under `max_bytes`.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 2**20, history_size: int = 5):
+        self.max_bytes = max_bytes
+        self.history_size = history_size
+        self.bytes = 0
+        self._versions = {}
+        self._current = {}
+        self._sizes = OrderedDict()
+        self.on_evict = None
+
+    def __getitem__(self, tag: str):
+        entry = self._versions[tag][-1]
+        if entry in self._sizes:
+            self._sizes.move_to_end(entry)
+        return entry
+
+    def __setitem__(self, tag: str, entry) -> None:
+        versions = self._versions.setdefault(tag, [])
+        if versions and versions[-1] is entry:
+            return
+        if versions:
+            self._uncount(versions[-1])
+        versions.append(entry)
+        del versions[: -max(self.history_size, 1)]
+
+        self._current[entry] = self._current.get(entry, 0) + 1
+        if entry not in self._sizes and not entry.result_released:
+            self._sizes[entry] = entry.result_size
+            self.bytes += self._sizes[entry]
+        self._shrink()
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._versions)
+
+    def __len__(self) -> int:
+        return len(self._versions)
+
+    def history(self, tag: str) -> list:
+        """Return the kept versions of a tag, oldest first."""
+        return list(self._versions[tag])
+
+    def clear(self) -> None:
+        """Remove all of the tags."""
+        self._versions.clear()
+        self._current.clear()
+        self._sizes.clear()
+        self.bytes = 0
+
+    def _uncount(self, entry) -> None:
+        # Release the value of an entry that's no longer current for any tag.
+        self._current[entry] -= 1
+        if self._current[entry] == 0:
+            del self._current[entry]
+            self._release(entry)
+
+    def _release(self, entry) -> None:
+        if entry in self._sizes:
+            self.bytes -= self._sizes.pop(entry)
+        entry.release_result()
+
+    def _shrink(self) -> None:
+        while self.bytes > self.max_bytes and self._sizes:
+            entry = next(iter(self._sizes))
+            if self.on_evict is not None:
+                self.on_evict(entry)
+            self._release(entry)
+
+
+def sizeof(obj: Any) -> int:
+    """
+    Estimate the number of bytes used by an object and the objects in it.
+    Arrays and data frames report their own size. Other objects are measured
+    by walking their contents.
+    """
+    memory_usage = getattr(obj, "memory_usage", None)
+    if callable(memory_usage):
+        # pandas
+        try:
+            usage = memory_usage(deep=True)
+            return int(usage.sum() if hasattr(usage, "sum") else usage)
+        except Exception:
+            pass
+
+    nbytes = getattr(obj, "nbytes", None)
+    if isinstance(nbytes, int):
+        # numpy, memoryview
+        return sys.getsizeof(obj, 0) + nbytes
+
+    size = 0
+    seen = set()
+    todo = [obj]
+    count = 0
+    while todo and count < _max_objects:
+        item = todo.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        count += 1
+        size += sys.getsizeof(item, 0)
+        if isinstance(item, dict):
+            todo.extend(item.keys())
+            todo.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            todo.extend(item)
+        elif hasattr(item, "__dict__") and not isinstance(
+            item, (type, types.ModuleType)
+        ):
+            todo.append(vars(item))
+
+    if todo:
+        # Assume the objects that weren't visited are like the ones inside of
+        # the container that were.
+        inner = size - sys.getsizeof(obj, 0)
+        size += inner // (count - 1) * len(todo)
+    return size
@@ -2,68 +2,112 @@
 Template configuration for nbtest
 """
 
-from jinja2 import Environment, PackageLoader, Template, select_autoescape
+# The templates in this package. They're loaded when they're first used.
+_names = ("missing", "assertion", "cancelled", "progress", "result", "wait")
 
 
 class _Templates:
     """Manage templates used by nbtest."""
 
     def __init__(self):
-        self.env = Environment(
-            loader=PackageLoader("nb_unittest"), autoescape=select_autoescape()
-        )
-
-    def _load(self, value):
-        if isinstance(value, Template):
-            return value
-        else:
+        self._env = None
+        self._reset()
+
+    def _reset(self):
+        self._templates = {name: f"{name}.html" for name in _names}
+
+    def _get(self, name):
+        value = self._templates[name]
+        if isinstance(value, str):
             # Assume file name in this package.
-            return self._env.get_template(value)
+            value = self._templates[name] = self.env.get_template(value)
+        return value
 
     @property
     def env(self):
+        if self._env is None:
+            self._env = _default_env()
         return self._env
 
     @env.setter
     def env(self, value):
         self._env = value
         # Load templates using self._env
-        self.missing = "missing.html"
-        self.assertion = "assertion.html"
-        self.result = "result.html"
-        self.wait = "wait.html"
+        self._reset()
 
     @property
     def assertion(self):
-        return self._assertion
+        return self._get("assertion")
 
     @assertion.setter
     def assertion(self, value):
-        self._assertion = self._load(value)
+        self._templates["assertion"] = value
+
+    @property
+    def cancelled(self):
+        return self._get("cancelled")
+
+    @cancelled.setter
+    def cancelled(self, value):
+        self._templates["cancelled"] = value
 
     @property
     def missing(self):
-        return self._missing
+        return self._get("missing")
 
     @missing.setter
     def missing(self, value):
-        self._missing = self._load(value)
+        self._templates["missing"] = value
+
+    @property
+    def progress(self):
+        return self._get("progress")
+
+    @progress.setter
+    def progress(self, value):
+        self._templates["progress"] = value
 
     @property
     def result(self):
-        return self._result
+        return self._get("result")
 
     @result.setter
     def result(self, value):
-        self._result = self._load(value)
+        self._templates["result"] = value
 
     @property
     def wait(self):
-        return self._wait
+        return self._get("wait")
 
     @wait.setter
     def wait(self, value):
-        self._wait = self._load(value)
+        self._templates["wait"] = value
+
+
+def _default_env():
+    """
+    Create the environment for the templates in this package. Compiled
+    templates are cached on disk so that new processes don't compile them
+    again.
+    """
+    from jinja2 import (
+        Environment,
+        FileSystemBytecodeCache,
+        PackageLoader,
+        select_autoescape,
+    )
+
+    try:
+        bytecode_cache = FileSystemBytecodeCache()
+    except (OSError, RuntimeError):
+        # There's no usable temporary directory.
+        bytecode_cache = None
+
+    return Environment(
+        loader=PackageLoader("nb_unittest"),
+        autoescape=select_autoescape(),
+        bytecode_cache=bytecode_cache,
+    )
 
 
 # Singleton instance.
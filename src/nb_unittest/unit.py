@@ -3,9 +3,26 @@ Simplifications of unittest classes that focus on readable results.
 """
 
 import asyncio
+import contextlib
+import itertools
+import queue
+import sys
+import threading
 import time
 import unittest
+from dataclasses import dataclass
 from types import TracebackType
+from typing import Callable, Iterable, Iterator, Union
+
+from .limits import (
+    LimitExceeded,
+    Limits,
+    Watchdog,
+    _grace,
+    _interval,
+    _set_async_exc,
+    exceeded,
+)
 
 try:
     from unittest.case import _addSkip, _Outcome
@@ -41,32 +58,264 @@ class NotebookTestSuite:
     def addTest(self, test):
         self._tests.append(test)
 
-    def run(self, result):
-        for test in self._tests:
+    def countTestCases(self) -> int:
+        return sum(test.countTestCases() for test in self._tests)
+
+    def run(
+        self,
+        result,
+        limits: Union[Limits, None] = None,
+        threads: int = 1,
+    ):
+        """
+        Run the tests. Each test case or suite from another library is run
+        with `limits`. If `threads` is more than one, consecutive function
+        tests run at the same time in a pool of that many threads.
+        """
+        for kind, batch in self._batches(threads=threads):
             if result.shouldStop:
                 return result
-            test.run(result)
+            if kind == "thread":
+                results = self._run_threads(batch, limits, threads)
+                result.merge_all(results)
+            else:
+                self._run_test(batch[0], result, limits, threads)
         return result
 
-    async def async_run(self, result):
-        for test in self._tests:
+    async def async_run(
+        self,
+        result,
+        limits: Union[Limits, None] = None,
+        concurrency: int = 1,
+        threads: int = 1,
+    ):
+        """
+        Run the tests asynchronously. Each test case is run with `limits`. If
+        `concurrency` is more than one, up to that many consecutive async
+        function tests are awaited at the same time. If `threads` is more
+        than one, consecutive function tests run in a pool of threads.
+        """
+        for kind, batch in self._batches(concurrency, threads):
             if result.shouldStop:
                 return result
-            if isinstance(test, unittest.TestCase):
-                await generic_async_run(test, result)
+            if kind == "async":
+                semaphore = asyncio.Semaphore(concurrency)
+
+                async def run_one(test):
+                    async with semaphore:
+                        other = NotebookResult()
+                        await self._async_run_test(test, other, limits)
+                        return other
+
+                results = await asyncio.gather(*map(run_one, batch))
+                result.merge_all(results)
+            elif kind == "thread":
+                workers = _TestThreads(self, batch, limits, threads)
+                try:
+                    while not workers.done.is_set():
+                        await asyncio.sleep(_interval)
+                except BaseException as e:
+                    workers.stop(e)
+                    raise
+                result.merge_all(workers.results)
             else:
-                await test.async_run(result)
+                await self._async_run_test(
+                    batch[0], result, limits, concurrency, threads
+                )
+        return result
+
+    def _batches(
+        self, concurrency: int = 1, threads: int = 1
+    ) -> Iterator[tuple[Union[str, None], list]]:
+        """
+        Group consecutive tests that can run at the same time. Tests that
+        must run alone are in batches of one with a kind of `None`.
+        """
+
+        def kind(test):
+            if concurrency > 1 and isinstance(test, AsyncFunctionTestCase):
+                return "async"
+            elif threads > 1 and type(test) is unittest.FunctionTestCase:
+                return "thread"
+            else:
+                return None
+
+        for key, batch in itertools.groupby(self._tests, key=kind):
+            if key is None:
+                for test in batch:
+                    yield None, [test]
+            else:
+                yield key, list(batch)
+
+    def _run_test(self, test, result, limits, threads=1):
+        if isinstance(test, NotebookTestSuite):
+            return test.run(result, limits, threads)
+        timing = {}
+        try:
+            with Watchdog(limits), _timed_parts(test, timing):
+                test.run(result)
+        except LimitExceeded:
+            result.addError(test, sys.exc_info())
+        if timing and hasattr(result, "addTiming"):
+            result.addTiming(test, timing)
         return result
 
+    def _run_threads(self, batch, limits, threads) -> list:
+        workers = _TestThreads(self, batch, limits, threads)
+        try:
+            # Wait in short steps so that the cell's limits can interrupt.
+            while not workers.done.wait(_interval):
+                pass
+        except BaseException as e:
+            workers.stop(e)
+            raise
+        return workers.results
+
+    async def _async_run_test(
+        self, test, result, limits, concurrency=1, threads=1
+    ):
+        if isinstance(test, NotebookTestSuite):
+            return await test.async_run(result, limits, concurrency, threads)
+        elif not isinstance(test, unittest.TestCase):
+            return await test.async_run(result)
+        try:
+            loop = asyncio.get_running_loop()
+            with Watchdog(limits, loop=loop) as watchdog:
+                await generic_async_run(test, result, watchdog)
+        except LimitExceeded:
+            result.addError(test, sys.exc_info())
+        return result
+
+
+class _TestThreads:
+    """
+    Function tests running in a pool of daemon threads, so a test that never
+    finishes can't keep the interpreter from exiting. `done` is set when every
+    test has finished and `results` has a NotebookResult for each test.
+    """
+
+    def __init__(self, suite, batch, limits, threads):
+        self.results = [None] * len(batch)
+        self.done = threading.Event()
+        self._suite = suite
+        self._limits = limits
+        self._todo = queue.SimpleQueue()
+        for item in enumerate(batch):
+            self._todo.put(item)
+        self._left = len(batch)
+        self._lock = threading.Lock()
+        self._threads = [
+            threading.Thread(
+                target=self._work, name="nbtest test", daemon=True
+            )
+            for _ in range(min(threads, len(batch)))
+        ]
+        if not batch:
+            self.done.set()
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, error: BaseException) -> None:
+        """
+        Stop the tests because the thread that waits for them was stopped by
+        `error`. Tests that haven't started are dropped and the ones that are
+        running get the cell's LimitExceeded, or `error` if it wasn't a limit.
+        """
+        while True:
+            try:
+                self._todo.get_nowait()
+            except queue.Empty:
+                break
+        if not isinstance(error, LimitExceeded):
+            error = exceeded() or error
+        kind = error if isinstance(error, type) else type(error)
+        deadline = time.monotonic() + _grace
+        for thread in self._threads:
+            if thread.is_alive():
+                _set_async_exc(thread.ident, kind)
+        for thread in self._threads:
+            thread.join(max(deadline - time.monotonic(), 0))
+
+    def _work(self) -> None:
+        while True:
+            try:
+                i, test = self._todo.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                self.results[i] = self._suite._run_test(
+                    test, NotebookResult(), self._limits
+                )
+            finally:
+                with self._lock:
+                    self._left -= 1
+                    if self._left == 0:
+                        self.done.set()
+
+
+@dataclass
+class TestTiming:
+    """How long each part of a test took to run, in seconds."""
+
+    name: str
+    test_id: str
+    setup: float = 0.0
+    test: float = 0.0
+    teardown: float = 0.0
+
+    @property
+    def total(self) -> float:
+        return self.setup + self.test + self.teardown
+
+
+@dataclass
+class TestRecord:
+    """
+    The outcome of one test in a form that can be exported.
+
+    outcome: One of "passed", "failed", "error", "skipped", "exceeded",
+        "expected failure" or "unexpected success".
+    severity: The severity of a failure, "error", "warning" or "info".
+    message: The failure or error message, or the reason for a skip.
+    duration: The time the test took in seconds, if it was timed.
+    """
+
+    test_id: str
+    name: str
+    outcome: str
+    severity: Union[str, None] = None
+    message: Union[str, None] = None
+    duration: Union[float, None] = None
+
 
 class NotebookResult(unittest.TestResult):
     """
     An implementation of unittest.TestResult
+
+    Besides the lists used by the report, every outcome is added to `records`
+    in the order the tests finished. `profile` is the CPUProfile of the run
+    when tests are profiled.
     """
 
     def __init__(self) -> None:
         super().__init__(None, None, None)
         self.successes = []
+        self.exceeded = []
+        self.timings = []
+        self.records = []
+        self.profile = None
+
+    def __getstate__(self) -> dict:
+        # The saved streams can't cross a process boundary.
+        state = self.__dict__.copy()
+        del state["_original_stdout"]
+        del state["_original_stderr"]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._original_stdout = sys.stdout
+        self._original_stderr = sys.stderr
 
     def addError(
         self,
@@ -74,6 +323,9 @@ class NotebookResult(unittest.TestResult):
         err: tuple[type[BaseException], BaseException, TracebackType]
         | tuple[None, None, None],
     ) -> None:
+        if isinstance(err[1], LimitExceeded):
+            self.addExceeded(self._format_test_name(test), err[1], test.id())
+            return
         self.stop()
         self.errors.append(
             (
@@ -81,6 +333,81 @@ class NotebookResult(unittest.TestResult):
                 self._format_error(err),
             )
         )
+        self._record(test, "error", "error", f"{err[0].__name__}: {err[1]}")
+
+    def merge(self, other: "NotebookResult") -> None:
+        """Add the outcomes of another result to this one."""
+        self.testsRun += other.testsRun
+        self.successes += other.successes
+        self.failures += other.failures
+        self.errors += other.errors
+        self.skipped += other.skipped
+        self.expectedFailures += other.expectedFailures
+        self.unexpectedSuccesses += other.unexpectedSuccesses
+        self.exceeded += other.exceeded
+        self.timings += other.timings
+        self.records += other.records
+        if other.shouldStop:
+            self.stop()
+
+    def merge_all(self, others: Iterable["NotebookResult"]) -> None:
+        """
+        Merge results of tests that ran at the same time, in the order the
+        tests were declared. Like a sequential run, results after the first
+        one that stops the run are dropped.
+        """
+        for other in others:
+            if self.shouldStop:
+                break
+            self.merge(other)
+
+    def addTiming(self, test: unittest.TestCase, timing: dict) -> None:
+        """
+        Record how long the parts of a test took. `timing` maps "setup",
+        "test" and "teardown" to seconds.
+        """
+        timing = TestTiming(self._format_test_name(test), test.id(), **timing)
+        self.timings.append(timing)
+        for record in reversed(self.records):
+            if record.test_id == timing.test_id:
+                if record.duration is None:
+                    record.duration = timing.total
+                break
+
+    def addExceeded(
+        self, name: str, error: LimitExceeded, test_id: Union[str, None] = None
+    ) -> None:
+        """
+        Record a test (or a whole cell) that went over a limit. A cell is
+        identified by its name.
+        """
+        self.stop()
+        self.exceeded.append((name, str(error)))
+        self.records.append(
+            TestRecord(test_id or name, name, "exceeded", "error", str(error))
+        )
+
+    def addCellError(
+        self,
+        name: str,
+        err: tuple[type[BaseException], BaseException, TracebackType],
+    ) -> None:
+        """
+        Record a problem that kept a cell of tests from running, like a
+        missing symbol. Assertions are failures and anything else is an error.
+        """
+        error = self._format_error(err)
+        if isinstance(error, str):
+            self.errors.append((name, error))
+            self.records.append(
+                TestRecord(name, name, "error", "error", error)
+            )
+        else:
+            self.failures.append((name, error))
+            severity = getattr(error, "severity", "error")
+            self.records.append(
+                TestRecord(name, name, "failed", severity, str(error))
+            )
 
     def addFailure(
         self,
@@ -95,9 +422,15 @@ class NotebookResult(unittest.TestResult):
                 self._format_error(err),
             )
         )
+        severity = getattr(err[1], "severity", "error")
+        self._record(test, "failed", severity, str(err[1]))
+
+    def wasSuccessful(self) -> bool:
+        return super().wasSuccessful() and not self.exceeded
 
     def addSuccess(self, test: unittest.TestCase) -> None:
         self.successes.append(self._format_test_name(test))
+        self._record(test, "passed")
 
     def addSkip(self, test: unittest.TestCase, reason: str) -> None:
         self.skipped.append(
@@ -106,6 +439,7 @@ class NotebookResult(unittest.TestResult):
                 reason,
             )
         )
+        self._record(test, "skipped", message=reason)
 
     def addExpectedFailure(
         self,
@@ -114,13 +448,34 @@ class NotebookResult(unittest.TestResult):
         | tuple[None, None, None],
     ) -> None:
         self.expectedFailures.append(
-            self._format_test_name(test),
-            self._format_error(err),
+            (
+                self._format_test_name(test),
+                self._format_error(err),
+            )
         )
+        self._record(test, "expected failure", message=str(err[1]))
 
     def addUnexpectedSuccess(self, test: unittest.TestCase) -> None:
         self.stop()
         self.unexpectedSuccesses.append(self._format_test_name(test))
+        self._record(test, "unexpected success")
+
+    def _record(
+        self,
+        test: unittest.TestCase,
+        outcome: str,
+        severity: Union[str, None] = None,
+        message: Union[str, None] = None,
+    ) -> None:
+        self.records.append(
+            TestRecord(
+                test.id(),
+                self._format_test_name(test),
+                outcome,
+                severity,
+                message,
+            )
+        )
 
     def _format_test_name(self, test: unittest.TestCase) -> str:
         # Getting unfiltered information from unittest isn't possible. Ugh.
@@ -152,16 +507,98 @@ class NotebookResult(unittest.TestResult):
             return err[1]
 
 
+class StreamingResult(NotebookResult):
+    """
+    A result that reports its progress while the tests run. `callback` is
+    called with the result as tests finish, at most once every `interval`
+    seconds, so tests that finish close together are reported together.
+    """
+
+    def __init__(self, callback: Callable, interval: float = 0.25) -> None:
+        super().__init__()
+        self.callback = callback
+        self.interval = interval
+        self._reported = time.monotonic()
+
+    def stopTest(self, test: unittest.TestCase) -> None:
+        super().stopTest(test)
+        self._progress()
+
+    def merge(self, other: NotebookResult) -> None:
+        super().merge(other)
+        self._progress()
+
+    def _progress(self) -> None:
+        now = time.monotonic()
+        if now - self._reported >= self.interval:
+            self._reported = now
+            self.callback(self)
+
+
 class NotebookTestRunner:
     """
     An simple test runner that provides an async run() method.
+
+    limits: Limits for running all of the tests.
+    test_limits: Limits for running each test.
+    concurrency: The number of async function tests to await at once.
+    threads: The number of threads that run function tests.
+
+    Tests only run at the same time when `concurrency` or `threads` is more
+    than one, so only raise them for tests that don't share state. Tests that
+    call run() on a cached cell share the notebook's output streams.
     """
 
-    async def async_run(self, test: NotebookTestSuite) -> NotebookResult:
-        return await test.async_run(NotebookResult())
+    def __init__(
+        self,
+        limits: Union[Limits, None] = None,
+        test_limits: Union[Limits, None] = None,
+        concurrency: int = 1,
+        threads: int = 1,
+    ):
+        self.limits = limits or Limits()
+        self.test_limits = test_limits or Limits()
+        self.concurrency = concurrency
+        self.threads = threads
+
+    async def async_run(
+        self,
+        test: NotebookTestSuite,
+        result: Union[NotebookResult, None] = None,
+    ) -> NotebookResult:
+        if result is None:
+            result = NotebookResult()
+        try:
+            loop = asyncio.get_running_loop()
+            with Watchdog(self.limits, "cell", loop) as watchdog:
+                await watchdog.wait(
+                    test.async_run(
+                        result,
+                        self.test_limits,
+                        self.concurrency,
+                        self.threads,
+                    )
+                )
+        except LimitExceeded as e:
+            result.addExceeded(_cell_name, e)
+        return result
+
+    def run(
+        self,
+        test: NotebookTestSuite,
+        result: Union[NotebookResult, None] = None,
+    ) -> NotebookResult:
+        if result is None:
+            result = NotebookResult()
+        try:
+            with Watchdog(self.limits, "cell"):
+                test.run(result, self.test_limits, self.threads)
+        except LimitExceeded as e:
+            result.addExceeded(_cell_name, e)
+        return result
 
-    def run(self, test: NotebookTestSuite) -> NotebookResult:
-        return test.run(NotebookResult())
+
+_cell_name = "The tests in this cell."
 
 
 class AsyncFunctionTestCase(unittest.FunctionTestCase):
@@ -179,7 +616,7 @@ class AsyncFunctionTestCase(unittest.FunctionTestCase):
             return self._testFunc()
 
 
-async def generic_async_run(self, result):
+async def generic_async_run(self, result, watchdog=None):
     """
     An async version of TestCase.run() defined here:
         https://github.com/python/cpython/blob/main/Lib/unittest/case.py
@@ -191,15 +628,28 @@ async def generic_async_run(self, result):
         https://youtu.be/XW7yv6HuWTE?si=0SV9ISfL2qUH11F7
 
     Hopefully the unittest library will catch up.
+
+    Coroutines are awaited with `watchdog`, if there is one, so they can be
+    stopped when they run over their limits.
     """
 
     async def run_or_await(func, *args, **kwargs):
-        if asyncio.iscoroutinefunction(func):
-            return await func(*args, **kwargs)
-        else:
-            return func(*args, **kwargs)
+        nonlocal cancelled
+        try:
+            if asyncio.iscoroutinefunction(func):
+                if watchdog is not None:
+                    return await watchdog.wait(func(*args, **kwargs))
+                return await func(*args, **kwargs)
+            else:
+                return func(*args, **kwargs)
+        except asyncio.CancelledError as e:
+            # The part executor reports everything as an error, remember the
+            # cancellation so that it reaches the task.
+            cancelled = e
+            raise
 
     stopTestRun = None
+    cancelled = None
 
     result.startTest(self)
     try:
@@ -218,26 +668,28 @@ async def generic_async_run(self, result):
             self, "__unittest_expecting_failure__", False
         ) or getattr(testMethod, "__unittest_expecting_failure__", False)
         outcome = _Outcome(result)
-        start_time = time.perf_counter()
+        timing = {}
         try:
             self._outcome = outcome
 
-            with outcome.testPartExecutor(self):
+            with outcome.testPartExecutor(self), _timer(timing, "setup"):
                 # self._callSetUp()
                 await run_or_await(self.setUp)
             if outcome.success:
                 outcome.expecting_failure = expecting_failure
-                with outcome.testPartExecutor(self):
+                with outcome.testPartExecutor(self), _timer(timing, "test"):
                     # self._callTestMethod(testMethod)
                     await run_or_await(testMethod)
                 outcome.expecting_failure = False
-                with outcome.testPartExecutor(self):
+                with (
+                    outcome.testPartExecutor(self),
+                    _timer(timing, "teardown"),
+                ):
                     # self._callTearDown()
                     await run_or_await(self.tearDown)
             self.doCleanups()
-
-            # XXX: Not until Python 3.12
-            # self._addDuration(result, (time.perf_counter() - start_time))
+            if cancelled is not None:
+                raise cancelled
 
             if outcome.success:
                 if expecting_failure:
@@ -249,6 +701,10 @@ async def generic_async_run(self, result):
                         self._addUnexpectedSuccess(result)
                 else:
                     result.addSuccess(self)
+
+            # TestResult.addDuration() is new in Python 3.12.
+            if hasattr(result, "addTiming"):
+                result.addTiming(self, timing)
             return result
         finally:
             # explicitly break reference cycle:
@@ -263,3 +719,44 @@ async def generic_async_run(self, result):
         result.stopTest(self)
         if stopTestRun is not None:
             stopTestRun()
+
+
+@contextlib.contextmanager
+def _timer(timing: dict, part: str) -> Iterator[None]:
+    """Store the time the block takes in `timing[part]`."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing[part] = time.perf_counter() - start
+
+
+@contextlib.contextmanager
+def _timed_parts(test, timing: dict) -> Iterator[None]:
+    """
+    Time the parts of a test that's run by TestCase.run(). The methods that
+    call each part are wrapped for the duration of the block.
+    """
+    if not isinstance(test, unittest.TestCase):
+        yield
+        return
+
+    def wrap(method, part):
+        def timed(*args, **kwargs):
+            with _timer(timing, part):
+                return method(*args, **kwargs)
+
+        return timed
+
+    parts = {
+        "_callSetUp": "setup",
+        "_callTestMethod": "test",
+        "_callTearDown": "teardown",
+    }
+    for name, part in parts.items():
+        setattr(test, name, wrap(getattr(test, name), part))
+    try:
+        yield
+    finally:
+        for name in parts:
+            delattr(test, name)